@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import contextlib
+import io
+import json
+import math
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+from router import Graph, MissingConnectionsError, Router
+
+# Router.get_path builds paths by concatenating node names and prints them by
+# joining characters, so every node has to be named by a single character.
+# Names start at the CJK block and skip the surrogate range.
+FIRST_NAME = 0x4E00
+SURROGATES = (0xD800, 0xE000)
+
+TOPOLOGIES = ["grid", "geometric", "scale-free", "fat-tree"]
+
+
+def node_name(i):
+    """
+    Returns a single character name for the i-th node of a generated graph.
+
+    Args:
+        i (int): index of the node
+
+    Returns:
+        string: one character node name
+    """
+    code = FIRST_NAME + i
+    if code >= SURROGATES[0]:
+        code += SURROGATES[1] - SURROGATES[0]
+    return chr(code)
+
+
+def grid_graph(size, rng):
+    """
+    Builds a square grid where each router is linked to its four neighbours.
+
+    Args:
+        size (int): minimum number of routers
+        rng (Random): seeded random number generator for link weights
+
+    Returns:
+        Graph: generated graph
+    """
+    side = math.ceil(math.sqrt(size))
+    g = Graph()
+    for row in range(side):
+        for col in range(side):
+            i = row * side + col
+            if col + 1 < side:
+                g.add_edge(node_name(i), node_name(i + 1), rng.randint(1, 20))
+            if row + 1 < side:
+                g.add_edge(node_name(i), node_name(i + side), rng.randint(1, 20))
+    return g
+
+
+def geometric_graph(size, rng):
+    """
+    Builds a random geometric graph. Routers are scattered over a unit square
+    and linked when they are within radio range of each other, weighted by
+    distance. Every router is also linked to its nearest earlier router so the
+    graph is always connected.
+
+    Args:
+        size (int): number of routers
+        rng (Random): seeded random number generator
+
+    Returns:
+        Graph: generated graph
+    """
+    radius = 1.5 * math.sqrt(math.log(max(size, 2)) / (math.pi * size))
+    points = [(rng.random(), rng.random()) for _ in range(size)]
+    g = Graph()
+    for i in range(1, size):
+        nearest = None
+        for j in range(i):
+            dist = math.dist(points[i], points[j])
+            if dist <= radius:
+                g.add_edge(node_name(i), node_name(j), max(1, round(dist * 100)))
+            if nearest is None or dist < nearest[0]:
+                nearest = (dist, j)
+        g.add_edge(node_name(i), node_name(nearest[1]), max(1, round(nearest[0] * 100)))
+    return g
+
+
+def scale_free_graph(size, rng, links=2):
+    """
+    Builds a scale-free graph with Barabasi-Albert preferential attachment.
+
+    Args:
+        size (int): number of routers
+        rng (Random): seeded random number generator
+        links (int): number of links each new router makes (default is 2)
+
+    Returns:
+        Graph: generated graph
+    """
+    g = Graph()
+    # Every router appears in targets once per link so picking uniformly
+    # from it is picking proportionally to degree
+    targets = []
+    for i in range(1, links + 1):
+        g.add_edge(node_name(i), node_name(0), rng.randint(1, 20))
+        targets += [i, 0]
+    for i in range(links + 1, size):
+        chosen = set()
+        while len(chosen) < links:
+            chosen.add(rng.choice(targets))
+        for j in chosen:
+            g.add_edge(node_name(i), node_name(j), rng.randint(1, 20))
+            targets += [i, j]
+    return g
+
+
+def fat_tree_graph(size, rng):
+    """
+    Builds a k-ary fat-tree data centre topology, using the smallest even k
+    that gives at least size routers and hosts. All links have a cost of 1.
+
+    Args:
+        size (int): minimum number of nodes
+        rng (Random): unused, kept so all generators share a signature
+
+    Returns:
+        Graph: generated graph
+    """
+    k = 2
+    while (5 * k * k + k ** 3) // 4 < size:
+        k += 2
+    half = k // 2
+    names = iter(node_name(i) for i in range((5 * k * k + k ** 3) // 4))
+    g = Graph()
+    cores = [next(names) for _ in range(half * half)]
+    for pod in range(k):
+        aggs = [next(names) for _ in range(half)]
+        edges = [next(names) for _ in range(half)]
+        for a, agg in enumerate(aggs):
+            for core in cores[a * half:(a + 1) * half]:
+                g.add_edge(agg, core, 1)
+            for edge in edges:
+                g.add_edge(agg, edge, 1)
+        for edge in edges:
+            for _ in range(half):
+                g.add_edge(edge, next(names), 1)
+    return g
+
+
+GENERATORS = {
+    "grid": grid_graph,
+    "geometric": geometric_graph,
+    "scale-free": scale_free_graph,
+    "fat-tree": fat_tree_graph,
+}
+
+
+def copy_graph(graph):
+    """
+    Copies the parts of a Graph that Router reads and mutates, so removals
+    in one run do not leak into the next.
+
+    Args:
+        graph (Graph): graph to copy
+
+    Returns:
+        Graph: independent copy of graph
+    """
+    g = Graph()
+    g.nodes = list(graph.nodes)
+    g.edges = {node: dict(links) for node, links in graph.edges.items()}
+    return g
+
+
+def measure(func, repeats, setup=None):
+    """
+    Times func over a number of runs, then runs it once more with memory
+    tracing on to record its peak memory, as tracing slows every allocation
+    down. Runs that find the graph disconnected are counted but left out of
+    the timings.
+
+    Args:
+        func (function): function to time, called with the arguments setup
+                         returns
+        repeats (int): number of timed runs
+        setup (function): returns a tuple of arguments for each run of func,
+                          and is not timed (default is None, for no
+                          arguments)
+
+    Returns:
+        dict: timings in seconds, None if every run failed, peak traced
+              memory in bytes and the number of runs that found the graph
+              disconnected
+    """
+    timings = []
+    failures = 0
+    for _ in range(repeats):
+        args = setup() if setup else ()
+        # Router prints its routing tables, which would swamp the timings
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            try:
+                func(*args)
+            except MissingConnectionsError:
+                failures += 1
+                continue
+            timings.append(time.perf_counter() - start)
+
+    args = setup() if setup else ()
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracemalloc.start()
+        try:
+            func(*args)
+        except MissingConnectionsError:
+            pass
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {
+        "min": min(timings) if timings else None,
+        "median": statistics.median(timings) if timings else None,
+        "mean": statistics.mean(timings) if timings else None,
+        "max": max(timings) if timings else None,
+        "peak_bytes": peak,
+        "disconnected": failures,
+    }
+
+
+def run_case(topology, size, repeats, seed):
+    """
+    Benchmarks a single query, a full routing table and a removal cycle on one
+    generated graph.
+
+    Args:
+        topology (string): name of generator in GENERATORS
+        size (int): requested number of nodes
+        repeats (int): number of timed runs per measurement
+        seed (int): seed for the graph and for picking routers
+
+    Returns:
+        dict: results for this topology and size
+    """
+    rng = random.Random("{}:{}:{}".format(seed, topology, size))
+    graph = GENERATORS[topology](size, rng)
+    source = graph.nodes[0]
+    # One more of each for the memory tracing run
+    targets = [rng.choice(graph.nodes[1:]) for _ in range(repeats + 1)]
+    victims = [rng.choice(graph.nodes[1:]) for _ in range(repeats + 1)]
+    router = Router(source, graph)
+
+    return {
+        "topology": topology,
+        "size": size,
+        "nodes": len(graph.nodes),
+        "edges": sum(len(links) for links in graph.edges.values()) // 2,
+        "get_path": measure(router.get_path, repeats, lambda: (targets.pop(),)),
+        "routing_table": measure(router.print_routing_table, repeats),
+        # The graph is copied outside the timing so removals do not leak
+        # into the next run
+        "remove_router": measure(Router.remove_router, repeats,
+                                 lambda: (Router(source, copy_graph(graph)), victims.pop())),
+    }
+
+
+def milliseconds(stats):
+    """
+    Args:
+        stats (dict): results of measure
+
+    Returns:
+        string: median time for printing
+    """
+    if stats["median"] is None:
+        return "disconnected"
+    return "{:.2f}ms".format(stats["median"] * 1000)
+
+
+def main():
+    """
+    Parses arguments, runs every topology at every size and writes the results
+    as JSON.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark Router on generated topologies.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[16, 64, 256])
+    parser.add_argument("--topologies", nargs="+", choices=TOPOLOGIES, default=TOPOLOGIES)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=304)
+    parser.add_argument("--output", help="file to write JSON results to (default is stdout)")
+    args = parser.parse_args()
+
+    results = []
+    for topology in args.topologies:
+        for size in args.sizes:
+            result = run_case(topology, size, args.repeats, args.seed)
+            print(f"{topology} {result['nodes']} nodes: "
+                  f"get_path {milliseconds(result['get_path'])}, "
+                  f"routing table {milliseconds(result['routing_table'])}, "
+                  f"remove {milliseconds(result['remove_router'])}",
+                  file=sys.stderr)
+            results.append(result)
+
+    report = {
+        "seed": args.seed,
+        "repeats": args.repeats,
+        "python": platform.python_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,12 @@ import matplotlib.pyplot as plt
 import networkx as nx
 import pandas
 
+class MissingConnectionsError(Exception):
+    """
+    Raised when a router can not be reached from the router finding paths.
+    """
+
+
 class Router:
     def __init__(self, name, graph):
         """
@@ -48,7 +54,7 @@ class Router:
             message: formated string of start, finish, cost and path
 
         Raises:
-            Exception: if there is a node with no path to it
+            MissingConnectionsError: if there is a node with no path to it
         """
         start = self.name
         finish = router_name
@@ -86,7 +92,7 @@ class Router:
             # find next node to travel to
             candidates = [node for node in unvisited.items() if node[1][0]]
             if not candidates:
-                raise Exception("There is a problem with your graph, missing connections")
+                raise MissingConnectionsError("There is a problem with your graph, missing connections")
             curr, dist_path = sorted(candidates, key = lambda x: x[1])[0]
             curr_distance, path = dist_path[0], dist_path[1]
 
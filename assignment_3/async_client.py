@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import asyncio
+import random
+import sys
+import time
+
+from logs import log, start_logging
+from protocol import JOIN, MESSAGE, PING, FrameDecoder, encode_frame, encode_message
+
+
+class AsyncClient:
+    def __init__(self, host, port, username, room, framed=True, heartbeat=15, queue_size=10000,
+                 batch_size=256, on_message=None, min_backoff=0.5, max_backoff=30):
+        """
+        Initialises an asyncio chat client for programs that publish messages,
+        such as bots and bridges. Messages are queued and written in batches,
+        so many can go out per system call without waiting for each other.
+        If the connection drops, the client reconnects with exponential
+        backoff, joins the room again and carries on with the queued
+        messages. A batch that failed to send is sent again, so a message may
+        arrive twice around a reconnect. It is only lost if the connection
+        dies after the batch has been written. Create it from inside the
+        event loop it will run on.
+
+        Args:
+            host (string): IP address of server
+            port (int): port number of server
+            username (string): username
+            room (string): name of chatroom
+            framed (bool): use the length prefixed protocol. Legacy servers
+                           take every read as one message, so without framing
+                           messages are written one at a time (default is
+                           True)
+            heartbeat (float): seconds between heartbeats on a framed
+                               connection, 0 to send none (default is 15)
+            queue_size (int): most messages waiting to be sent before send
+                              blocks (default is 10000)
+            batch_size (int): most messages written at once (default is 256)
+            on_message (callable): called with the text of every message
+                                   received, or None to ignore them (default
+                                   is None)
+            min_backoff (float): seconds to wait before the first reconnect
+                                 attempt (default is 0.5)
+            max_backoff (float): longest wait between reconnect attempts
+                                 (default is 30)
+        """
+        self.host = host
+        self.port = port
+        self.username = username
+        self.room = room
+        self.framed = framed
+        self.heartbeat = heartbeat
+        self.batch_size = batch_size if framed else 1
+        self.on_message = on_message
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.outgoing = asyncio.Queue(queue_size)
+        # Batch taken from the queue whose write failed, sent first after
+        # reconnecting
+        self.unsent = []
+        self.connected = asyncio.Event()
+        self.connections = 0
+        self.sent = 0
+        self.received = 0
+        self.connected_at = 0
+        self.last_heard = 0
+        self.task = None
+
+    async def start(self):
+        """
+        Starts connecting in the background and waits until the room has
+        been joined for the first time.
+        """
+        self.task = asyncio.ensure_future(self.run())
+        await self.connected.wait()
+
+    async def send(self, text):
+        """
+        Queues a message, waiting for room in the queue if the server or the
+        connection can not keep up.
+
+        Args:
+            text (string): message to send
+        """
+        await self.outgoing.put(encode_message(text, self.framed))
+
+    async def flush(self):
+        """
+        Waits until every queued message has been written.
+        """
+        await self.outgoing.join()
+
+    async def close(self):
+        """
+        Stops the client and closes its connection.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def run(self):
+        """
+        Keeps a connection to the server open, reconnecting with exponential
+        backoff and jitter whenever it fails or drops. The backoff only goes
+        back to its minimum once a connection has proved healthy, by hearing
+        from the server or staying up for max_backoff seconds, so a server
+        that accepts connections and drops them at once is not hammered.
+        """
+        backoff = self.min_backoff
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            except OSError as e:
+                log.warning("Could not connect to %s:%d (%s)", self.host, self.port, e)
+            else:
+                self.connected_at = time.monotonic()
+                try:
+                    await self.serve(reader, writer)
+                except OSError as e:
+                    log.warning("Connection failed: %s", e)
+                finally:
+                    self.connected.clear()
+                    writer.close()
+                now = time.monotonic()
+                if self.last_heard > self.connected_at or now - self.connected_at >= self.max_backoff:
+                    backoff = self.min_backoff
+                log.warning("Lost connection to %s:%d", self.host, self.port)
+            delay = backoff * random.uniform(0.5, 1)
+            log.warning("Reconnecting to %s:%d in %.1fs", self.host, self.port, delay)
+            await asyncio.sleep(delay)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    async def serve(self, reader, writer):
+        """
+        Joins the room and runs the reading, writing and heartbeat tasks until
+        one of them ends, which means the connection is no longer usable.
+
+        Args:
+            reader (StreamReader): reading end of the connection
+            writer (StreamWriter): writing end of the connection
+        """
+        if self.framed:
+            writer.write(encode_frame(JOIN, self.room.encode('ascii')))
+        else:
+            writer.write(self.room.encode('ascii'))
+            # Give a legacy server its own read for the room name
+            await writer.drain()
+            await asyncio.sleep(0.05)
+        self.connections += 1
+        self.connected.set()
+        tasks = [asyncio.ensure_future(self.read_loop(reader)),
+                 asyncio.ensure_future(self.write_loop(writer))]
+        if self.framed and self.heartbeat > 0:
+            tasks.append(asyncio.ensure_future(self.heartbeat_loop(writer)))
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+        errors = [task.exception() for task in done if not task.cancelled() and task.exception() is not None]
+        if errors:
+            log.warning("Connection failed: %s", errors[0])
+
+    async def read_loop(self, reader):
+        """
+        Hands every message the server sends to on_message until the server
+        closes the connection.
+
+        Args:
+            reader (StreamReader): reading end of the connection
+        """
+        decoder = FrameDecoder() if self.framed else None
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            self.last_heard = time.monotonic()
+            if decoder is None:
+                messages = [data]
+            else:
+                decoder.feed(data)
+                messages = [payload for frame_type, payload in decoder.frames() if frame_type == MESSAGE]
+            self.received += len(messages)
+            if self.on_message is not None:
+                for message in messages:
+                    self.on_message(message.decode('ascii', 'replace'))
+
+    async def write_loop(self, writer):
+        """
+        Writes queued messages, taking every message that is waiting up to
+        batch_size and writing them together.
+
+        Args:
+            writer (StreamWriter): writing end of the connection
+        """
+        while True:
+            if not self.unsent:
+                self.unsent = [await self.outgoing.get()]
+                while len(self.unsent) < self.batch_size and not self.outgoing.empty():
+                    self.unsent.append(self.outgoing.get_nowait())
+            writer.write(b"".join(self.unsent))
+            await writer.drain()
+            if not self.framed:
+                # Keep legacy messages in separate reads on the server
+                await asyncio.sleep(0.001)
+            self.sent += len(self.unsent)
+            for _ in self.unsent:
+                self.outgoing.task_done()
+            self.unsent = []
+
+    async def heartbeat_loop(self, writer):
+        """
+        Pings the server every heartbeat interval, and returns once nothing
+        has been heard from it for three intervals.
+
+        Args:
+            writer (StreamWriter): writing end of the connection
+        """
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            if time.monotonic() - max(self.last_heard, self.connected_at) > 3 * self.heartbeat:
+                log.warning("%s:%d has stopped answering", self.host, self.port)
+                return
+            writer.write(encode_frame(PING, b""))
+
+
+async def stream(args, source):
+    """
+    Sends every line of source to the room at up to args.rate lines per
+    second, then waits for them all to be written. Lines that are not ASCII
+    can not be sent, so they are logged and skipped.
+
+    Args:
+        args (Namespace): parsed arguments, see main
+        source (file): file to read lines from
+
+    Returns:
+        AsyncClient: the client, for its counts
+    """
+    loop = asyncio.get_running_loop()
+    on_message = None if args.quiet else print
+    client = AsyncClient(args.host, args.port, args.username, args.room, framed=not args.legacy,
+                         heartbeat=args.heartbeat, batch_size=args.batch, on_message=on_message)
+    await client.start()
+    # A terminal is read a line at a time, anything else in large chunks
+    read = source.readline if source.isatty() else lambda: source.readlines(65536)
+    start = loop.time()
+    queued = 0
+    while True:
+        lines = await loop.run_in_executor(None, read)
+        if not lines:
+            break
+        for line in [lines] if isinstance(lines, str) else lines:
+            if args.rate > 0:
+                delay = start + queued / args.rate - loop.time()
+                if delay > 0.001:
+                    await asyncio.sleep(delay)
+            try:
+                await client.send("{}: {}".format(args.username, line.rstrip("\n")))
+            except UnicodeEncodeError:
+                log.warning("Skipping a line that is not ASCII: %r", line[:64])
+                continue
+            queued += 1
+    await client.flush()
+    await client.close()
+    client.elapsed = loop.time() - start
+    return client
+
+
+def main():
+    """
+    Parses arguments and streams lines from a file or stdin to a chat room.
+    """
+    parser = argparse.ArgumentParser(description="Stream messages to a chat room from a file or stdin.")
+    parser.add_argument("username")
+    parser.add_argument("host")
+    parser.add_argument("port", type=int)
+    parser.add_argument("room")
+    parser.add_argument("--file", help="file of messages, one per line (default is stdin)")
+    parser.add_argument("--rate", type=float, default=0, help="most messages per second, 0 for no limit")
+    parser.add_argument("--batch", type=int, default=256, help="most messages written at once")
+    parser.add_argument("--heartbeat", type=float, default=15, help="seconds between heartbeats, 0 to send none")
+    parser.add_argument("--legacy", action="store_true", help="send unframed messages, for servers without framing")
+    parser.add_argument("--quiet", action="store_true", help="do not print messages from the room")
+    args = parser.parse_args()
+
+    listener = start_logging()
+    source = open(args.file) if args.file else sys.stdin
+    try:
+        client = asyncio.run(stream(args, source))
+        log.info("Sent %d messages in %.2fs (%.0f/s) over %d connection(s)", client.sent, client.elapsed,
+                 client.sent / client.elapsed if client.elapsed else 0, client.connections)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.file:
+            source.close()
+        listener.stop()
+
+
+if __name__ == "__main__":
+    main()
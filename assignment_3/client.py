@@ -1,14 +1,17 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import argparse
 import os
 import socket
-import sys
 import threading
+import time
+
+from protocol import JOIN, MESSAGE, PING, FrameDecoder, ProtocolError, encode_frame, encode_message
 
 
 class Client:
-    def __init__(self, host, port, username, room):
+    def __init__(self, host, port, username, room, framed=True, heartbeat=15):
         """
         Initialises Client object.
 
@@ -17,41 +20,65 @@ class Client:
             port (int): port number of server
             username (string): username
             room (string): name of chatroom
+            framed (bool): use the length prefixed protocol, turn off for
+                           servers that only speak the legacy protocol
+                           (default is True)
+            heartbeat (float): seconds between heartbeats on a framed
+                               connection, 0 to send none (default is 15)
         """
 
         self.host = host
         self.port = port
         self.username = username
         self.room = room
+        self.framed = framed
+        self.heartbeat = heartbeat
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Held around every write once more than one thread is sending
+        self.send_lock = threading.Lock()
+
+    def connect(self):
+        """
+        Connects to the server and sends the name of the chatroom.
+        """
+        self.sock.connect((self.host, self.port))
+        if self.framed:
+            self.sock.sendall(encode_frame(JOIN, self.room.encode('ascii')))
+        else:
+            self.sock.sendall(self.room.encode('ascii'))
 
     def start(self):
         """
         Establishes the server-client connection. Creates and starts the Send
-        and Receive threads, and notifies other connected clients.
+        and Receive threads, and notifies other connected clients. On a framed
+        connection a Heartbeat thread then keeps the server from timing the
+        client out.
         """
 
         print ("Trying to connect to {}:{}...".format(self.host, self.port))
-        self.sock.connect((self.host, self.port))
+        self.connect()
         print ("Successfully connected to {}:{}".format(self.host, self.port))
-        self.sock.sendall(self.room.encode('ascii'))
 
         print ()
         print ('Welcome, {}! Getting ready to send and receive messages...'.format(self.username))
 
-        send = Send(self.sock, self.username)
-        receive = Receive(self.sock, self.username)
+        send = Send(self.sock, self.username, self.framed, self.send_lock)
+        receive = Receive(self.sock, self.username, self.framed)
 
         send.start()
         receive.start()
 
-        self.sock.sendall('Server: {} has joined the chat. Say hi!'.format(self.username).encode("ascii"))
+        with self.send_lock:
+            self.sock.sendall(encode_message('Server: {} has joined the chat. Say hi!'.format(self.username),
+                                             self.framed))
+        if self.framed and self.heartbeat > 0:
+            Heartbeat(self.sock, self.heartbeat, self.send_lock, receive).start()
         print ("\rAll set! Leave the chatroom anytime by typing 'QUIT'\n")
         print ("{}: ".format(self.username), end = "")
 
 
 class Send(threading.Thread):
-    def __init__(self, sock, username):
+    def __init__(self, sock, username, framed, lock):
         """
         Initialises Send thread. Sending thread listens for user input from the
         command line.
@@ -59,10 +86,14 @@ class Send(threading.Thread):
         Args:
             sock (socket): The connected ssocket object
             username (string): username
+            framed (bool): whether to frame messages
+            lock (Lock): held while writing to sock
         """
         super().__init__()
         self.sock = sock
         self.username = username
+        self.framed = framed
+        self.lock = lock
 
     def run(self):
         """
@@ -73,17 +104,20 @@ class Send(threading.Thread):
             message = input('{}: '.format(self.username))
 
             if message == "QUIT":
-                self.sock.sendall("Server: {} has left the chat.".format(self.username).encode('ascii'))
+                with self.lock:
+                    self.sock.sendall(encode_message("Server: {} has left the chat.".format(self.username),
+                                                     self.framed))
                 break
             else:
-                self.sock.sendall('{}: {}'.format(self.username, message).encode('ascii'))
+                with self.lock:
+                    self.sock.sendall(encode_message('{}: {}'.format(self.username, message), self.framed))
 
         print ("\nQuitting...")
         self.sock.close()
         os._exit(0)
 
 class Receive(threading.Thread):
-    def __init__(self, sock, username):
+    def __init__(self, sock, username, framed):
         """
         Initialises Receive thread. Receiving thread listens for incoming messages
         from the server.
@@ -91,10 +125,13 @@ class Receive(threading.Thread):
         Args:
             sock (socket): The connected ssocket object
             username (string): username
+            framed (bool): whether messages from the server are framed
         """
         super().__init__()
         self.sock = sock
         self.username = username
+        self.decoder = FrameDecoder() if framed else None
+        self.last_heard = time.monotonic()
 
     def run(self):
         """
@@ -102,23 +139,87 @@ class Receive(threading.Thread):
         Always listens for incoming data until either end has closed the socket.
         """
         while True:
-            message = self.sock.recv(1024)
-            if message:
-                print ('\r{}\n{}: '.format(message.decode('ascii'), self.username), end = "")
-            else:
+            messages = self.receive()
+            if messages:
+                for message in messages:
+                    print ('\r{}\n{}: '.format(message.decode('ascii'), self.username), end = "")
+            elif messages is None:
                 print ('\nOh no, we have lost connection to the server!')
                 print ('\nQuitting...')
                 self.sock.close()
                 os._exit(0)
 
+    def receive(self):
+        """
+        Blocks until the server sends more data.
+
+        Returns:
+            list: list of complete messages as bytes, or None if the server
+                  has closed the connection or sent a bad frame
+        """
+        try:
+            if self.decoder is None:
+                message = self.sock.recv(1024)
+                return [message] if message else None
+            if not self.decoder.read_from(self.sock):
+                return None
+            self.last_heard = time.monotonic()
+            return [payload for frame_type, payload in self.decoder.frames() if frame_type == MESSAGE]
+        except (OSError, ProtocolError):
+            return None
+
+
+class Heartbeat(threading.Thread):
+    def __init__(self, sock, interval, lock, receive):
+        """
+        Initialises Heartbeat thread. Heartbeat thread pings the server so it
+        knows this client is still there, and notices when the server has
+        stopped answering without closing the connection.
+
+        Args:
+            sock (socket): The connected socket object
+            interval (float): seconds between pings
+            lock (Lock): held while writing to sock
+            receive (Receive): receiving thread, which records when the
+                               server was last heard from
+        """
+        super().__init__(daemon=True)
+        self.sock = sock
+        self.interval = interval
+        self.lock = lock
+        self.receive = receive
+
+    def run(self):
+        """
+        Sends a ping every interval. If nothing, not even a pong, has come
+        back for three intervals the server is taken to be gone.
+        """
+        while True:
+            time.sleep(self.interval)
+            if time.monotonic() - self.receive.last_heard > 3 * self.interval:
+                print ('\nOh no, the server has stopped answering!')
+                print ('\nQuitting...')
+                self.sock.close()
+                os._exit(0)
+            try:
+                with self.lock:
+                    self.sock.sendall(encode_frame(PING, b""))
+            except OSError:
+                return
+
 
 if __name__ == "__main__":
-    if len(sys.argv) == 5:
-        username = sys.argv[1]
-        ip = sys.argv[2]
-        port = int(sys.argv[3])
-        room = sys.argv[4]
-        client = Client(ip, port, username, room)
-        client.start()
-    else:
-        print ("Missing {} Arguments".format(5 - len(sys.argv)))
+    parser = argparse.ArgumentParser(description="Chat room client.")
+    parser.add_argument("username")
+    parser.add_argument("host")
+    parser.add_argument("port", type=int)
+    parser.add_argument("room")
+    parser.add_argument("--legacy", action="store_true",
+                        help="send unframed messages, for servers without framing")
+    parser.add_argument("--heartbeat", type=float, default=15,
+                        help="seconds between heartbeats, 0 to send none")
+    args = parser.parse_args()
+
+    client = Client(args.host, args.port, args.username, args.room, framed=not args.legacy,
+                    heartbeat=args.heartbeat)
+    client.start()
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import resource
+import selectors
+import socket
+import threading
+import time
+
+from history import MessageHistory
+from idle import IdleTracker
+from logs import log
+from metrics import Metrics
+from protocol import (JOIN, MESSAGE, PING, PONG, OutgoingMessage, ProtocolError, decode_room, detect_decoder,
+                      encode_frame)
+from rooms import RoomRegistry
+from send_queue import DROP_OLDEST, SendQueue, advance
+
+
+class EventServer(threading.Thread):
+
+    def __init__(self, host, port, queue_size=1024, overflow=DROP_OLDEST, history=None, metrics=None,
+                 idle_timeout=60):
+        """
+        Initialises the EventServer thread. Unlike Server, every client is
+        handled by one selector loop in this thread instead of a thread each,
+        so accepting and the room handshake never block on a slow client.
+
+        Args:
+            host (string): IP address of server
+            port (int): port number of server
+            queue_size (int): most messages waiting to be sent to one client
+                              (default is 1024)
+            overflow (string): send_queue policy when a client's queue is full
+                               (default is DROP_OLDEST)
+            history (MessageHistory): recent messages replayed to clients
+                                      joining a room (default is a
+                                      MessageHistory with default limits)
+            metrics (Metrics): where to record live metrics (default is a
+                               Metrics with default settings)
+            idle_timeout (float): seconds without hearing from a framed
+                                  client before it is disconnected, 0 to
+                                  never disconnect (default is 60)
+        """
+        super().__init__()
+        self.connections = RoomRegistry()
+        self.host = host
+        self.port = port
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.history = history if history is not None else MessageHistory()
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.idle = IdleTracker(idle_timeout)
+        self.selector = selectors.DefaultSelector()
+        raise_fd_limit()
+
+
+    def run(self):
+        """
+        Creates the non-blocking listening socket and runs the event loop,
+        dispatching to accept, read and write handlers as sockets become ready.
+        The loop wakes up at least once a tick to turn the idle timer wheel.
+        """
+        sock = self.listen()
+        sock.setblocking(False)
+        self.selector.register(sock, selectors.EVENT_READ, self.accept)
+        log.info("Listening at %s", sock.getsockname())
+        self.metrics.start(self)
+
+        next_tick = time.monotonic() + self.idle.tick
+        while True:
+            timeout = max(0, next_tick - time.monotonic()) if self.idle.timeout > 0 else None
+            for key, mask in self.selector.select(timeout):
+                key.data(key.fileobj, mask)
+            if self.idle.timeout > 0 and time.monotonic() >= next_tick:
+                next_tick += self.idle.tick
+                self.reap()
+
+    def reap(self):
+        """
+        Closes every connection that has not been heard from for the idle
+        timeout.
+        """
+        for connection in self.idle.expire():
+            log.info("%s has not been heard from, disconnecting", connection.sockname)
+            self.metrics.connection_idle()
+            connection.close()
+
+    def listen(self):
+        """
+        Returns:
+            socket: socket listening on self.host and self.port
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(socket.SOMAXCONN)
+        return sock
+
+    def accept(self, sock, mask):
+        """
+        Accepts every pending connection. The client is not put in a room until
+        it has sent the room name, which is read by EventSocket.on_read.
+
+        Args:
+            sock (socket): listening socket
+            mask (int): selector events that are ready
+        """
+        while True:
+            try:
+                sc, sockname = sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # Out of file descriptors, try again on the next event
+                log.warning("Could not accept connection: %s", e)
+                return
+            sc.setblocking(False)
+            self.metrics.connection_opened()
+            connection = EventSocket(sc, sockname, self)
+            self.selector.register(sc, selectors.EVENT_READ, connection.handle)
+            self.idle.touch(connection)
+
+    def join(self, connection, rest):
+        """
+        Adds a connection that has finished the handshake to its room and
+        queues the room's recent messages for it as one write.
+
+        Args:
+            connection (EventSocket): connection that has named its room
+            rest (list): frames received after the room name, unused here
+
+        Returns:
+            bool: True if the connection stays on this server
+        """
+        replay = self.history.replay(connection.room_name)
+        self.connections.join(connection.room_name, connection)
+        if replay:
+            connection.send(b"".join(m.encoded(connection.decoder.framed) for m in replay))
+        log.info("Ready to receive messages from %s", connection.sockname)
+        return True
+
+    def broadcast(self, message, source, room_name):
+        """
+        Queues the given message for all clients in the same room as the source
+        except the source. The message is encoded at most once for the whole
+        room.
+
+        Args:
+            message (bytes): message payload as received
+            source (tuple): tuple of host and port
+            room_name (string): name of room that source is in
+        """
+        start = time.perf_counter()
+        outgoing = OutgoingMessage(message)
+        self.history.append(room_name, outgoing)
+        for connection in self.connections.members(room_name):
+            if connection.sockname != source:
+                connection.send(outgoing.encoded(connection.decoder.framed))
+        self.metrics.broadcast_took(time.perf_counter() - start)
+
+    def queue_depths(self):
+        """
+        Returns:
+            dict: number of messages waiting for each client, keyed by room
+                  and then by client address
+        """
+        return {room: {connection.sockname: connection.queue_depth() for connection in connections}
+                for room, connections in self.connections.items()}
+
+    def remove_connection(self, connection):
+        """
+        Unregisters the given connection and removes it from self.connections.
+
+        Args:
+            connection (EventSocket): connection to be removed
+        """
+        self.selector.unregister(connection.sc)
+        self.idle.forget(connection)
+        if connection.room_name is not None:
+            self.connections.leave(connection.room_name, connection)
+
+    def close_connections(self):
+        """
+        Closes the socket of every connection in every room.
+        """
+        for room, connections in self.connections.items():
+            for connection in connections:
+                connection.sc.close()
+
+
+class EventSocket:
+    def __init__(self, sc, sockname, server):
+        """
+        Initialises the state of one client connection of an EventServer.
+
+        Args:
+            sc (socket): non-blocking socket object
+            sockname (tuple): tuple of host and port
+            server (EventServer): server object where socket is registered
+        """
+        self.sc = sc
+        self.sockname = sockname
+        self.server = server
+        self.room_name = None
+        self.decoder = None
+        self.queue = SendQueue(server.queue_size, server.overflow)
+        # Buffers taken from the queue that are not fully sent yet. They are
+        # kept out of the queue so dropping the oldest message never cuts one
+        # in half.
+        self.pending = []
+        self.writing = False
+
+    def handle(self, sc, mask):
+        """
+        Selector callback for the connected socket.
+
+        Args:
+            sc (socket): the connected socket
+            mask (int): selector events that are ready
+        """
+        if mask & selectors.EVENT_WRITE:
+            self.on_write()
+        if mask & selectors.EVENT_READ and self.sc.fileno() != -1:
+            self.on_read()
+
+    def on_read(self):
+        """
+        Reads whatever the client has sent. The first frame names the room, as
+        in ServerSocket, and every message after that is broadcast to the room.
+        Legacy clients can not send heartbeats, so they are left to TCP
+        keepalive instead of the idle timer wheel.
+        """
+        try:
+            if self.decoder is None:
+                self.decoder = detect_decoder(self.sc)
+                if self.decoder is not None and not self.decoder.framed:
+                    self.server.idle.keep_alive(self, self.sc)
+            received = self.decoder is not None and self.decoder.read_from(self.sc)
+            frames = self.decoder.frames() if received else []
+        except (BlockingIOError, InterruptedError):
+            return
+        except (OSError, ProtocolError):
+            received = False
+        if not received:
+            log.info("%s has closed the connection", self.sockname)
+            self.close()
+            return
+        if self.decoder.framed:
+            self.server.idle.touch(self)
+        self.handle_frames(frames)
+
+    def handle_frames(self, frames):
+        """
+        Joins the room named by the first frame, broadcasts every message
+        after that and answers heartbeats. A client that names a room that
+        can not be decoded is closed.
+
+        Args:
+            frames (list): list of (frame type, payload bytes) tuples
+        """
+        for i, (frame_type, payload) in enumerate(frames):
+            if frame_type == JOIN and self.room_name is None:
+                try:
+                    self.room_name = decode_room(payload)
+                except ProtocolError as e:
+                    log.warning("%s sent a bad room name: %s", self.sockname, e)
+                    self.close()
+                    return
+                if not self.server.join(self, frames[i + 1:]):
+                    return
+            elif frame_type == MESSAGE and self.room_name is not None:
+                self.server.metrics.message_in(self.room_name, len(payload))
+                if self.server.metrics.sample_log():
+                    log.info("%s says %r", self.sockname, payload)
+                self.server.broadcast(payload, self.sockname, self.room_name)
+            elif frame_type == PING:
+                self.send(encode_frame(PONG, payload))
+
+    def on_write(self):
+        """
+        Sends queued messages in batches of one sendmsg call until the queue
+        is empty or the socket would block, and only waits for writability
+        while there is something left.
+        """
+        while True:
+            taken = 0
+            if not self.pending:
+                self.pending = self.queue.get_batch_nowait()
+                taken = len(self.pending)
+                if not self.pending:
+                    break
+            try:
+                sent = self.sc.sendmsg(self.pending)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                self.close()
+                return
+            self.server.metrics.sent(self.room_name, taken, sent)
+            if not sent:
+                break
+            self.pending = advance(self.pending, sent)
+            if self.pending:
+                break
+        waiting = bool(self.pending)
+        if waiting != self.writing:
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE if waiting else selectors.EVENT_READ
+            self.server.selector.modify(self.sc, events, self.handle)
+            self.writing = waiting
+
+    def send(self, message):
+        """
+        Queues the given message and sends it straight away unless earlier
+        messages are still waiting. If the queue is full under the DISCONNECT
+        policy the client is too slow to keep up and is closed.
+
+        Args:
+            message (bytes): message encoded for this client
+        """
+        if self.sc.fileno() == -1:
+            return
+        if not self.queue.put(message):
+            log.warning("%s is not keeping up, disconnecting", self.sockname)
+            self.close()
+        elif not self.writing:
+            self.on_write()
+
+    def queue_depth(self):
+        """
+        Returns:
+            int: number of messages waiting to be sent, including ones
+                 taken from the queue that are not fully sent
+        """
+        return len(self.queue) + len(self.pending)
+
+    def close(self):
+        """
+        Closes the connected socket and removes it from the server.
+        """
+        if self.sc.fileno() == -1:
+            return
+        self.queue.close()
+        self.server.metrics.connection_closed()
+        self.server.remove_connection(self)
+        self.sc.close()
+
+
+def raise_fd_limit():
+    """
+    Raises the soft limit on open files to the hard limit, since each client
+    holds a file descriptor and the default soft limit is often 1024.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from collections import deque
+import threading
+
+
+class MessageHistory:
+    def __init__(self, max_messages=50, max_bytes=65536, max_total_bytes=16 * 1024 * 1024):
+        """
+        Initialises ring buffers of the most recent messages in each room, so
+        clients joining a room can be sent what they missed. Each room keeps
+        at most max_messages messages and max_bytes of encoded messages, and
+        once all rooms together hold more than max_total_bytes the oldest
+        messages of any room are dropped first.
+
+        Args:
+            max_messages (int): most messages kept per room, 0 keeps none
+                                (default is 50)
+            max_bytes (int): most message bytes kept per room, frame headers
+                             included (default is 64KiB)
+            max_total_bytes (int): most message bytes kept over all rooms,
+                                   frame headers included (default is 16MiB)
+        """
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_total_bytes = max_total_bytes
+        # room name -> deque of (sequence number, OutgoingMessage)
+        self.rooms = {}
+        self.room_bytes = {}
+        self.total_bytes = 0
+        self.count = 0
+        # (sequence number, room name) of every kept message, oldest first,
+        # for dropping across rooms. Entries for messages a room has already
+        # dropped itself are skipped when they reach the front.
+        self.order = deque()
+        self.sequence = 0
+        # Reentrant so a server can hold it across append or replay and its
+        # own room bookkeeping
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        """
+        Returns:
+            int: number of messages kept over all rooms
+        """
+        return self.count
+
+    def append(self, room_name, message):
+        """
+        Keeps a broadcast message, dropping old messages to stay in bounds.
+
+        Args:
+            room_name (string): name of room the message was sent to
+            message (OutgoingMessage): message as broadcast
+        """
+        size = len(message.frame)
+        if self.max_messages <= 0 or size > self.max_bytes or size > self.max_total_bytes:
+            return
+        with self.lock:
+            self.sequence += 1
+            messages = self.rooms.setdefault(room_name, deque())
+            messages.append((self.sequence, message))
+            self.order.append((self.sequence, room_name))
+            self.room_bytes[room_name] = self.room_bytes.get(room_name, 0) + size
+            self.total_bytes += size
+            self.count += 1
+
+            while len(messages) > self.max_messages or self.room_bytes[room_name] > self.max_bytes:
+                self._drop_oldest(room_name)
+            while self.total_bytes > self.max_total_bytes:
+                sequence, oldest_room = self.order.popleft()
+                oldest = self.rooms.get(oldest_room)
+                if oldest and oldest[0][0] == sequence:
+                    self._drop_oldest(oldest_room)
+            # Entries skipped above are only cleared from the front, so
+            # rebuild the order when too many have piled up behind it
+            if len(self.order) > 2 * self.count + 64:
+                self.order = deque(sorted((sequence, name) for name, kept in self.rooms.items()
+                                          for sequence, m in kept))
+
+    def replay(self, room_name):
+        """
+        Args:
+            room_name (string): name of room
+
+        Returns:
+            list: OutgoingMessages kept for the room, oldest first
+        """
+        with self.lock:
+            return [message for sequence, message in self.rooms.get(room_name, ())]
+
+    def _drop_oldest(self, room_name):
+        """
+        Drops the oldest message of a room, and the room once it is empty.
+        Caller must hold self.lock.
+        """
+        messages = self.rooms[room_name]
+        sequence, message = messages.popleft()
+        size = len(message.frame)
+        self.room_bytes[room_name] -= size
+        self.total_bytes -= size
+        self.count -= 1
+        if not messages:
+            del self.rooms[room_name]
+            del self.room_bytes[room_name]
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import math
+import socket
+import threading
+
+
+class IdleTracker:
+    def __init__(self, timeout=60, tick=1.0):
+        """
+        Initialises a timer wheel of connections that have not been heard
+        from. The wheel has one slot per tick of the timeout, plus one, and a
+        connection sits in the slot of the tick it last sent something in.
+        Hearing from a connection moves it to the current slot and each tick
+        empties the slot the wheel turns onto, so the work per tick is only
+        the connections that have timed out, however many are connected.
+
+        Args:
+            timeout (float): seconds without hearing from a connection before
+                             it is evicted, 0 to never evict (default is 60)
+            tick (float): seconds between turns of the wheel (default is 1)
+        """
+        self.timeout = timeout
+        self.tick = tick
+        count = int(math.ceil(timeout / tick)) + 1 if timeout > 0 else 0
+        self.slots = [set() for _ in range(count)]
+        # connection -> index of the slot it is in
+        self.slot_of = {}
+        self.current = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        """
+        Returns:
+            int: number of connections being tracked
+        """
+        return len(self.slot_of)
+
+    def touch(self, connection):
+        """
+        Records that a connection has just been heard from, starting to track
+        it if it is new.
+
+        Args:
+            connection (object): connection that sent something
+        """
+        if not self.slots:
+            return
+        with self.lock:
+            slot = self.slot_of.get(connection)
+            if slot == self.current:
+                return
+            if slot is not None:
+                self.slots[slot].discard(connection)
+            self.slots[self.current].add(connection)
+            self.slot_of[connection] = self.current
+
+    def forget(self, connection):
+        """
+        Stops tracking a connection, for example once it has closed.
+
+        Args:
+            connection (object): connection to stop tracking
+        """
+        with self.lock:
+            slot = self.slot_of.pop(connection, None)
+            if slot is not None:
+                self.slots[slot].discard(connection)
+
+    def keep_alive(self, connection, sock):
+        """
+        Stops tracking a connection that can not send heartbeats, such as a
+        legacy client, and leaves noticing a dead peer to TCP keepalive
+        instead, probing after the same timeout.
+
+        Args:
+            connection (object): connection to stop tracking
+            sock (socket): the connection's socket
+        """
+        self.forget(connection)
+        if not self.slots:
+            return
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        idle = max(1, int(self.timeout))
+        for option, value in (("TCP_KEEPIDLE", idle), ("TCP_KEEPINTVL", max(1, idle // 4)), ("TCP_KEEPCNT", 4)):
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+    def expire(self):
+        """
+        Turns the wheel one tick. Call once every self.tick seconds.
+
+        Returns:
+            set: connections not heard from for at least self.timeout seconds,
+                 which are no longer tracked
+        """
+        if not self.slots:
+            return set()
+        with self.lock:
+            self.current = (self.current + 1) % len(self.slots)
+            expired = self.slots[self.current]
+            self.slots[self.current] = set()
+            for connection in expired:
+                del self.slot_of[connection]
+            return expired
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import os
+import platform
+import random
+import selectors
+import subprocess
+import sys
+import time
+
+from client import Client
+from protocol import MESSAGE, PING, PONG, FrameDecoder, ProtocolError, encode_frame, encode_message
+
+
+class LoadClient(Client):
+    def __init__(self, host, port, index, room):
+        """
+        Initialises a headless client. It joins like Client but never reads
+        from the terminal, and timestamps what it sends so receivers can work
+        out fan-out latency.
+
+        Args:
+            host (string): IP address of server
+            port (int): port number of server
+            index (int): client number, used for its username
+            room (string): name of chatroom
+        """
+        super().__init__(host, port, "lt{}".format(index), room)
+        self.decoder = FrameDecoder(recv_size=16384)
+        self.sent = 0
+        # perf_counter time the client started connecting, until the server
+        # has answered the ping sent after joining
+        self.joining = None
+
+    def join(self):
+        """
+        Connects, joins the room and pings the server. The server answers
+        frames in order, so its pong means the join has been handled.
+        """
+        self.joining = time.perf_counter()
+        self.connect()
+        self.sock.sendall(encode_frame(PING, b""))
+
+    def send_timed(self, size):
+        """
+        Sends one message carrying the time it was sent.
+
+        Args:
+            size (int): total message length to pad to
+        """
+        text = "{}: {} ".format(self.username, time.perf_counter_ns())
+        self.sock.sendall(encode_message(text.ljust(size, "x"), self.framed))
+        self.sent += 1
+
+
+class LoadTest:
+    def __init__(self, args):
+        """
+        Initialises a load test run from parsed command line arguments.
+
+        Args:
+            args (Namespace): parsed arguments, see main
+        """
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.selector = selectors.DefaultSelector()
+        self.clients = []
+        self.room_sizes = {}
+        self.connect_times = []
+        self.connect_errors = 0
+        self.disconnects = 0
+        self.latencies = []
+        self.expected = 0
+        self.memory = []
+        self.server = None
+        self.last_heartbeat = time.perf_counter()
+
+    def run(self):
+        """
+        Joins every client at the configured rate, sends messages at the
+        configured rate for the configured duration and waits for the last
+        deliveries.
+
+        Returns:
+            dict: results of the run
+        """
+        args = self.args
+        if args.spawn:
+            self.spawn_server()
+        try:
+            start = time.perf_counter()
+            self.join_clients()
+            join_seconds = time.perf_counter() - start
+            # Give the server time to finish the handshakes before measuring
+            self.poll_until(time.perf_counter() + args.settle)
+            self.latencies = []
+
+            start = time.perf_counter()
+            sent = self.send_messages(start + args.duration)
+            send_seconds = time.perf_counter() - start
+            self.poll_until(time.perf_counter() + args.drain)
+            return self.report(join_seconds, send_seconds, sent)
+        finally:
+            for client in self.clients:
+                client.sock.close()
+            if self.server is not None:
+                self.stop_server()
+
+    def spawn_server(self):
+        """
+        Starts a local server.py to test against, with any extra arguments
+        given by --server-args.
+        """
+        server_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+        command = [sys.executable, server_py, self.args.host, str(self.args.port)] + self.args.server_args.split()
+        self.server = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        self.args.server_pid = self.server.pid
+        time.sleep(1)
+
+    def stop_server(self):
+        """
+        Quits the spawned server through its console.
+        """
+        try:
+            self.server.communicate(b"q\n", timeout=5)
+        except (subprocess.TimeoutExpired, BrokenPipeError):
+            self.server.kill()
+
+    def join_clients(self):
+        """
+        Connects clients at --join-rate per second, reading any deliveries in
+        between so the server is never blocked on this process.
+        """
+        args = self.args
+        start = time.perf_counter()
+        for i in range(args.clients):
+            self.poll_until(start + i / args.join_rate)
+            room = "room{}".format(i % args.rooms)
+            client = LoadClient(args.host, args.port, i, room)
+            try:
+                client.join()
+            except OSError:
+                self.connect_errors += 1
+                client.sock.close()
+                continue
+            self.selector.register(client.sock, selectors.EVENT_READ, client)
+            self.clients.append(client)
+            self.room_sizes[room] = self.room_sizes.get(room, 0) + 1
+            self.sample_memory()
+
+    def send_messages(self, deadline):
+        """
+        Sends messages from randomly picked clients at --message-rate per
+        second until deadline.
+
+        Args:
+            deadline (float): perf_counter time to stop sending
+
+        Returns:
+            int: number of messages sent
+        """
+        start = time.perf_counter()
+        sent = 0
+        if not self.clients:
+            return sent
+        while True:
+            now = time.perf_counter()
+            if now >= deadline or not self.clients:
+                return sent
+            due = int((now - start) * self.args.message_rate) - sent
+            for _ in range(due):
+                if not self.clients:
+                    break
+                client = self.rng.choice(self.clients)
+                try:
+                    client.send_timed(self.args.size)
+                except OSError:
+                    self.drop(client)
+                    continue
+                self.expected += self.room_sizes[client.room] - 1
+                sent += 1
+            self.sample_memory()
+            self.poll_until(min(deadline, now + 1 / self.args.message_rate))
+
+    def poll_until(self, deadline):
+        """
+        Reads deliveries until deadline and records their latency, sending
+        heartbeats when they are due. Reads at least once even if deadline
+        has passed, so falling behind the join or message rate does not
+        leave deliveries and pongs unread.
+
+        Args:
+            deadline (float): perf_counter time to return at
+        """
+        while True:
+            timeout = deadline - time.perf_counter()
+            self.send_heartbeats()
+            for key, mask in self.selector.select(max(timeout, 0)):
+                client = key.data
+                try:
+                    if not client.decoder.read_from(client.sock):
+                        raise ProtocolError("Server closed the connection")
+                    frames = client.decoder.frames()
+                except (OSError, ProtocolError):
+                    self.drop(client)
+                    continue
+                now = time.perf_counter_ns()
+                for frame_type, payload in frames:
+                    if frame_type == PONG and client.joining is not None:
+                        self.connect_times.append(now / 1e9 - client.joining)
+                        client.joining = None
+                    if frame_type != MESSAGE:
+                        continue
+                    fields = payload.split(b" ", 2)
+                    if len(fields) > 1 and fields[1].isdigit():
+                        self.latencies.append((now - int(fields[1])) / 1e6)
+            if timeout <= 0:
+                return
+
+    def drop(self, client):
+        """
+        Forgets a client whose connection has failed or been closed by the
+        server, so it is neither sent from nor expected to receive.
+
+        Args:
+            client (LoadClient): client to drop
+        """
+        self.selector.unregister(client.sock)
+        client.sock.close()
+        self.clients.remove(client)
+        self.room_sizes[client.room] -= 1
+        self.disconnects += 1
+
+    def send_heartbeats(self):
+        """
+        Pings the server from every client each --heartbeat seconds, so
+        clients that have not sent a message lately are not timed out.
+        """
+        now = time.perf_counter()
+        if not self.args.heartbeat or now - self.last_heartbeat < self.args.heartbeat:
+            return
+        self.last_heartbeat = now
+        ping = encode_frame(PING, b"")
+        for client in list(self.clients):
+            try:
+                client.sock.sendall(ping)
+            except OSError:
+                self.drop(client)
+
+    def sample_memory(self):
+        """
+        Records the resident memory of the server, at most ten times a second.
+        """
+        if not self.args.server_pid:
+            return
+        now = time.perf_counter()
+        if self.memory and now - self.memory[-1][0] < 0.1:
+            return
+        rss = rss_bytes(self.args.server_pid)
+        if rss is not None:
+            self.memory.append((now, rss))
+
+    def report(self, join_seconds, send_seconds, sent):
+        """
+        Returns:
+            dict: configuration and measurements of this run
+        """
+        args = self.args
+        latencies = sorted(self.latencies)
+        connects = sorted(t * 1000 for t in self.connect_times)
+        return {
+            "config": {key: value for key, value in vars(args).items() if key != "output"},
+            "python": platform.python_version(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "clients": len(self.clients),
+            "connect_errors": self.connect_errors,
+            "disconnects": self.disconnects,
+            "unconfirmed_joins": sum(1 for client in self.clients if client.joining is not None),
+            "connect_ms": percentiles(connects),
+            "join_rate": (len(self.clients) + self.disconnects) / join_seconds if join_seconds else None,
+            "messages_sent": sent,
+            "send_rate": sent / send_seconds,
+            "deliveries_expected": self.expected,
+            "deliveries": len(latencies),
+            "delivery_rate": len(latencies) / send_seconds,
+            "fanout_latency_ms": percentiles(latencies),
+            "server_rss_bytes": {
+                "first": self.memory[0][1] if self.memory else None,
+                "peak": max(rss for t, rss in self.memory) if self.memory else None,
+            },
+        }
+
+
+def percentiles(values):
+    """
+    Args:
+        values (list): sorted list of numbers
+
+    Returns:
+        dict: p50, p90, p99, p99.9 and max of values, or None if empty
+    """
+    if not values:
+        return None
+    result = {}
+    for name, q in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("p999", 0.999)):
+        result[name] = values[min(len(values) - 1, int(q * len(values)))]
+    result["max"] = values[-1]
+    return result
+
+
+def rss_bytes(pid):
+    """
+    Reads the resident memory of a process and all its descendants, so a
+    server running --workers is measured as a whole.
+
+    Args:
+        pid (int): process id
+
+    Returns:
+        int: resident memory in bytes, or None if the process is gone
+    """
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:"))
+    except (OSError, StopIteration):
+        return None
+    try:
+        with open("/proc/{0}/task/{0}/children".format(pid)) as f:
+            children = [int(child) for child in f.read().split()]
+    except OSError:
+        children = []
+    for child in children:
+        rss += rss_bytes(child) or 0
+    return rss
+
+
+def main():
+    """
+    Parses arguments, runs the load test and writes the results as JSON.
+    """
+    parser = argparse.ArgumentParser(description="Load test the chat server with headless clients.")
+    parser.add_argument("host", nargs="?", default="127.0.0.1")
+    parser.add_argument("port", nargs="?", type=int, default=8080)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--rooms", type=int, default=50)
+    parser.add_argument("--join-rate", type=float, default=500, help="new connections per second")
+    parser.add_argument("--message-rate", type=float, default=200, help="messages per second over all clients")
+    parser.add_argument("--size", type=int, default=64, help="bytes per message")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to send messages for")
+    parser.add_argument("--settle", type=float, default=1, help="seconds to wait after joining")
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait for deliveries after sending")
+    parser.add_argument("--heartbeat", type=float, default=15, help="seconds between pings, 0 to send none")
+    parser.add_argument("--seed", type=int, default=304)
+    parser.add_argument("--server-pid", type=int, help="pid of the server, to sample its memory")
+    parser.add_argument("--spawn", action="store_true", help="start a local server.py to test against")
+    parser.add_argument("--server-args", default="", help="extra arguments for the spawned server")
+    parser.add_argument("--output", help="file to write JSON results to (default is stdout)")
+    args = parser.parse_args()
+
+    report = LoadTest(args).run()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
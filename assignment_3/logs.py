@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import itertools
+import logging
+import logging.handlers
+import queue
+import sys
+
+log = logging.getLogger("chat")
+
+
+def start_logging(level=logging.INFO):
+    """
+    Sends log records through a queue to a listener thread that writes them
+    to stdout, so logging never blocks the thread handling messages on
+    terminal or pipe I/O.
+
+    Args:
+        level (int): lowest level to log (default is logging.INFO)
+
+    Returns:
+        QueueListener: the running listener
+    """
+    records = queue.SimpleQueue()
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(logging.Formatter("%(message)s"))
+    listener = logging.handlers.QueueListener(records, output)
+    listener.start()
+    log.handlers = [logging.handlers.QueueHandler(records)]
+    log.setLevel(level)
+    log.propagate = False
+    return listener
+
+
+class Sampler:
+    def __init__(self, every=100):
+        """
+        Initialises a sampler for per message log lines, which are only worth
+        writing for one message in every so many.
+
+        Args:
+            every (int): log one in this many, 0 to log none (default is 100)
+        """
+        self.every = every
+        self.counter = itertools.count()
+
+    def __call__(self):
+        """
+        Returns:
+            bool: True if this call should be logged
+        """
+        return self.every > 0 and next(self.counter) % self.every == 0
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import threading
+import time
+
+from logs import Sampler, log
+
+# Upper bounds of the latency histogram buckets: 1us doubling up to ~8s
+LATENCY_BUCKETS = [1e-6 * 2 ** i for i in range(24)]
+
+
+class Histogram:
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        """
+        Initialises a fixed bucket histogram, cheap enough to update for
+        every message.
+
+        Args:
+            bounds (list): sorted upper bounds of the buckets, anything larger
+                           goes in an overflow bucket (default is
+                           LATENCY_BUCKETS)
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        """
+        Args:
+            value (float): value to record
+        """
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def quantile(self, q):
+        """
+        Args:
+            q (float): quantile between 0 and 1
+
+        Returns:
+            float: upper bound of the bucket holding the quantile, or None if
+                   nothing has been recorded
+        """
+        if not self.count:
+            return None
+        seen = 0
+        for bound, count in zip(self.bounds + [float("inf")], self.counts):
+            seen += count
+            if seen >= q * self.count:
+                return bound
+        return float("inf")
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: count, mean, estimated quantiles and non-empty buckets
+        """
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "buckets": {str(bound): count for bound, count in zip(self.bounds + ["inf"], self.counts) if count},
+        }
+
+
+class Metrics:
+    def __init__(self, interval=5, stats_file=None, stats_port=0, log_sample=100):
+        """
+        Initialises the live metrics of a chat server: connections, messages
+        and bytes per room, broadcast fan-out latency and send queue depths.
+        Once started, a reporter thread works out per room rates every
+        interval and writes a snapshot to stats_file, and a stats endpoint
+        serves the latest snapshot as JSON over HTTP on localhost.
+
+        Args:
+            interval (float): seconds between rate updates and snapshot files
+                              (default is 5)
+            stats_file (string): file to write snapshots to, or None for no
+                                 file (default is None)
+            stats_port (int): localhost port for the stats endpoint, or 0 for
+                              no endpoint (default is 0)
+            log_sample (int): log one in this many received messages, 0 to
+                              log none (default is 100)
+        """
+        self.interval = interval
+        self.stats_file = stats_file
+        self.stats_port = stats_port
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.connections_opened = 0
+        self.connections_closed = 0
+        self.connections_idle = 0
+        # room name -> [messages in, bytes in, messages out, bytes out]
+        self.rooms = {}
+        # Same counts over every room, kept when idle rooms are forgotten
+        self.totals = [0, 0, 0, 0]
+        self.previous = {}
+        self.rates = {}
+        self.fanout = Histogram()
+        self.sample_log = Sampler(log_sample)
+        self.server = None
+
+    def connection_opened(self):
+        """
+        Counts a newly accepted connection.
+        """
+        with self.lock:
+            self.connections_opened += 1
+
+    def connection_closed(self):
+        """
+        Counts a closed connection.
+        """
+        with self.lock:
+            self.connections_closed += 1
+
+    def connection_idle(self):
+        """
+        Counts a connection closed for not being heard from, which is also
+        counted as closed once it has gone.
+        """
+        with self.lock:
+            self.connections_idle += 1
+
+    def message_in(self, room_name, size):
+        """
+        Args:
+            room_name (string): room the message was sent to
+            size (int): payload bytes
+        """
+        with self.lock:
+            counts = self.rooms.get(room_name)
+            if counts is None:
+                counts = self.rooms[room_name] = [0, 0, 0, 0]
+            counts[0] += 1
+            counts[1] += size
+            self.totals[0] += 1
+            self.totals[1] += size
+
+    def sent(self, room_name, messages, size):
+        """
+        Args:
+            room_name (string): room of the client that was written to
+            messages (int): number of messages written
+            size (int): bytes written
+        """
+        with self.lock:
+            # Heartbeat replies can go out before a client has joined a room
+            if room_name is not None:
+                counts = self.rooms.get(room_name)
+                if counts is None:
+                    counts = self.rooms[room_name] = [0, 0, 0, 0]
+                counts[2] += messages
+                counts[3] += size
+            self.totals[2] += messages
+            self.totals[3] += size
+
+    def broadcast_took(self, seconds):
+        """
+        Args:
+            seconds (float): time taken to hand one message to every member
+                             of its room
+        """
+        with self.lock:
+            self.fanout.observe(seconds)
+
+    def start(self, server):
+        """
+        Starts the reporter thread and, if a port is set, the stats endpoint.
+
+        Args:
+            server: server whose queue depths and rooms are reported
+        """
+        self.server = server
+        threading.Thread(target=self.report, daemon=True).start()
+        if self.stats_port:
+            metrics = self
+
+            class StatsHandler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = json.dumps(metrics.snapshot()).encode('utf-8')
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            endpoint = ThreadingHTTPServer(("127.0.0.1", self.stats_port), StatsHandler)
+            endpoint.daemon_threads = True
+            threading.Thread(target=endpoint.serve_forever, daemon=True).start()
+            log.info("Stats at http://127.0.0.1:%d/", self.stats_port)
+
+    def report(self):
+        """
+        Reporter thread. Updates rates and writes the snapshot file every
+        interval.
+        """
+        last = time.time()
+        while True:
+            time.sleep(self.interval)
+            now = time.time()
+            self.update_rates(now - last)
+            last = now
+            if self.stats_file:
+                self.write_snapshot()
+
+    def update_rates(self, elapsed):
+        """
+        Works out per room rates since the last update. Rooms that no longer
+        exist and had no traffic are forgotten.
+
+        Args:
+            elapsed (float): seconds since the last update
+        """
+        active = set(name for name, members in self.server.connections.items())
+        with self.lock:
+            rates = {}
+            for name, counts in list(self.rooms.items()):
+                before = self.previous.get(name, [0, 0, 0, 0])
+                delta = [now - then for now, then in zip(counts, before)]
+                if not any(delta) and name not in active:
+                    del self.rooms[name]
+                    continue
+                rates[name] = {
+                    "messages_in": delta[0] / elapsed,
+                    "bytes_in": delta[1] / elapsed,
+                    "messages_out": delta[2] / elapsed,
+                    "bytes_out": delta[3] / elapsed,
+                }
+            self.previous = {name: list(counts) for name, counts in self.rooms.items()}
+            self.rates = rates
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: every metric, with per second rates from the last update
+        """
+        depths = self.server.queue_depths() if self.server is not None else {}
+        members = dict((name, len(connections)) for name, connections in self.server.connections.items()) \
+            if self.server is not None else {}
+        with self.lock:
+            rooms = {}
+            for name, counts in self.rooms.items():
+                room_depths = depths.get(name, {}).values()
+                rooms[name] = {
+                    "members": members.get(name, 0),
+                    "messages_in": counts[0],
+                    "bytes_in": counts[1],
+                    "messages_out": counts[2],
+                    "bytes_out": counts[3],
+                    "rates": self.rates.get(name),
+                    "queue_depth_total": sum(room_depths),
+                    "queue_depth_max": max(room_depths, default=0),
+                }
+            return {
+                "time": time.time(),
+                "uptime": time.time() - self.started,
+                "connections": {
+                    "open": self.connections_opened - self.connections_closed,
+                    "opened": self.connections_opened,
+                    "closed": self.connections_closed,
+                    "idle_closed": self.connections_idle,
+                },
+                "messages_in": self.totals[0],
+                "bytes_in": self.totals[1],
+                "messages_out": self.totals[2],
+                "bytes_out": self.totals[3],
+                "fanout_seconds": self.fanout.snapshot(),
+                "rooms": rooms,
+            }
+
+    def write_snapshot(self):
+        """
+        Writes a snapshot to self.stats_file, replacing the old one in one
+        rename so readers never see half a file.
+        """
+        temp = self.stats_file + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(self.snapshot(), f, indent=2)
+        os.replace(temp, self.stats_file)
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Framing for the chat protocol.
+
+A framed message is a 4 byte big-endian payload length, a 1 byte frame type
+and the payload. Frames are capped well below 16MiB so the first byte of every
+framed connection is 0, which no legacy client sends as a room name. Servers
+peek at that byte to decide whether a client is framed or legacy, where every
+recv is taken as one whole message.
+
+Framed clients send a PING every few seconds, which the server answers with a
+PONG carrying the same payload, so each end can tell a peer that has gone away
+without closing the connection from one that is just quiet.
+"""
+import socket
+import struct
+import threading
+
+HEADER = struct.Struct(">IB")
+MAX_FRAME = 1 << 20
+FRAME_MARKER = b"\x00"
+RECV_SIZE = 65536
+
+# Frame types
+JOIN = 1
+MESSAGE = 2
+PING = 3
+PONG = 4
+
+
+class ProtocolError(Exception):
+    """
+    Raised when a peer sends a frame that can not be decoded.
+    """
+
+
+def encode_frame(frame_type, payload):
+    """
+    Encodes a single frame.
+
+    Args:
+        frame_type (int): one of the frame types above
+        payload (bytes): frame body
+
+    Returns:
+        bytes: length prefixed frame
+    """
+    return HEADER.pack(len(payload), frame_type) + payload
+
+
+def decode_room(payload):
+    """
+    Decodes the room name a client joins with.
+
+    Args:
+        payload (bytes): JOIN frame payload, or a legacy client's first read
+
+    Returns:
+        string: room name
+
+    Raises:
+        ProtocolError: if the name is not ASCII
+    """
+    try:
+        return payload.decode('ascii')
+    except UnicodeDecodeError:
+        raise ProtocolError("Room name {!r} is not ASCII".format(payload[:64])) from None
+
+
+def encode_message(text, framed):
+    """
+    Encodes a chat line for the wire.
+
+    Args:
+        text (string): message to send
+        framed (bool): whether the peer speaks the framed protocol
+
+    Returns:
+        bytes: encoded message
+    """
+    payload = text.encode('ascii')
+    if framed:
+        return encode_frame(MESSAGE, payload)
+    return payload
+
+
+class OutgoingMessage:
+    # Kept by the thousand in the history, so without a dict per message
+    __slots__ = ("frame",)
+
+    def __init__(self, payload):
+        """
+        Wraps a received message payload so a broadcast can send the same bytes
+        to every client. The message is framed once and legacy clients are
+        sent a view of the payload inside the frame, so a message kept in the
+        history holds a single copy of its bytes.
+
+        Args:
+            payload (bytes): message as received
+        """
+        self.frame = encode_frame(MESSAGE, payload)
+
+    def encoded(self, framed):
+        """
+        Args:
+            framed (bool): whether the client speaks the framed protocol
+
+        Returns:
+            bytes: message ready to write to the client, a memoryview for
+                   legacy clients
+        """
+        if framed:
+            return self.frame
+        return memoryview(self.frame)[HEADER.size:]
+
+
+# Receive buffer of each thread, shared by every decoder reading in it
+receive_buffers = threading.local()
+
+
+def receive_buffer():
+    """
+    Returns:
+        memoryview: RECV_SIZE byte buffer of the calling thread, made the
+                    first time the thread reads
+    """
+    view = getattr(receive_buffers, "view", None)
+    if view is None:
+        view = receive_buffers.view = memoryview(bytearray(RECV_SIZE))
+    return view
+
+
+class FrameDecoder:
+    framed = True
+
+    def __init__(self, recv_size=RECV_SIZE):
+        """
+        Initialises an incremental decoder for framed connections. Data is
+        read into the receive buffer of the reading thread, which every
+        connection served by that thread shares, and only the bytes of frames
+        that have not fully arrived are kept per connection. An idle
+        connection holds no buffer at all.
+
+        Args:
+            recv_size (int): largest single read, at most RECV_SIZE (default
+                             is RECV_SIZE)
+        """
+        self.pending = bytearray()
+        self.recv_size = min(recv_size, RECV_SIZE)
+
+    def read_from(self, sock):
+        """
+        Reads whatever is available from sock into the decoder.
+
+        Args:
+            sock (socket): connected socket
+
+        Returns:
+            int: number of bytes read, 0 when the peer has closed
+        """
+        buffer = receive_buffer()
+        n = sock.recv_into(buffer, self.recv_size)
+        self.pending += buffer[:n]
+        return n
+
+    def feed(self, data):
+        """
+        Adds already received data to the decoder.
+
+        Args:
+            data (bytes): received bytes
+        """
+        self.pending += data
+
+    def frames(self):
+        """
+        Decodes every complete frame received so far. Incomplete frames stay
+        buffered until the rest of them arrives.
+
+        Returns:
+            list: list of (frame type, payload bytes) tuples
+
+        Raises:
+            ProtocolError: if a frame is longer than MAX_FRAME
+        """
+        frames = []
+        offset = 0
+        while len(self.pending) - offset >= HEADER.size:
+            length, frame_type = HEADER.unpack_from(self.pending, offset)
+            if length > MAX_FRAME:
+                raise ProtocolError("Frame of {} bytes is too long".format(length))
+            end = offset + HEADER.size + length
+            if end > len(self.pending):
+                break
+            frames.append((frame_type, bytes(self.pending[offset + HEADER.size:end])))
+            offset = end
+        if offset:
+            del self.pending[:offset]
+        return frames
+
+
+class LegacyDecoder:
+    framed = False
+
+    def __init__(self, recv_size=1024):
+        """
+        Initialises a decoder for clients that do not frame their messages.
+        As in the original protocol, the first read names the room and every
+        read after that is one message.
+
+        Args:
+            recv_size (int): largest single read (default is 1024)
+        """
+        self.recv_size = recv_size
+        self.joined = False
+        self.pending = []
+
+    def read_from(self, sock):
+        """
+        Reads one message from sock.
+
+        Args:
+            sock (socket): connected socket
+
+        Returns:
+            int: number of bytes read, 0 when the peer has closed
+        """
+        data = sock.recv(self.recv_size)
+        if data:
+            self.feed(data)
+        return len(data)
+
+    def feed(self, data):
+        """
+        Adds one already received message to the decoder.
+
+        Args:
+            data (bytes): received bytes
+        """
+        self.pending.append((MESSAGE if self.joined else JOIN, data))
+        self.joined = True
+
+    def frames(self):
+        """
+        Returns:
+            list: list of (frame type, payload bytes) tuples read so far
+        """
+        frames, self.pending = self.pending, []
+        return frames
+
+
+def detect_decoder(sock):
+    """
+    Peeks at the first byte a client has sent to pick its decoder. The byte is
+    left in the socket for the decoder to read.
+
+    Args:
+        sock (socket): newly accepted socket with data ready to read
+
+    Returns:
+        FrameDecoder or LegacyDecoder: decoder for the client, or None if the
+        client closed before sending anything
+    """
+    first = sock.recv(1, socket.MSG_PEEK)
+    if not first:
+        return None
+    if first == FRAME_MARKER:
+        return FrameDecoder()
+    return LegacyDecoder()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import threading
+
+
+class Room:
+    def __init__(self, name):
+        """
+        Initialises an empty chat room.
+
+        Args:
+            name (string): name of room
+        """
+        self.name = name
+        # Dict rather than list so leaving is O(1). Values are unused.
+        self.members = {}
+        self.snapshot = ()
+
+
+class RoomRegistry:
+    def __init__(self):
+        """
+        Initialises a thread-safe registry of which connections are in which
+        room. Joining and leaving are O(1) under a lock. Readers get an
+        immutable snapshot of a room's members, rebuilt only after the room
+        has changed, so a broadcast can iterate it without holding the lock
+        while other threads join and leave.
+        """
+        self.rooms = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        """
+        Returns:
+            int: number of rooms with at least one member
+        """
+        return len(self.rooms)
+
+    def join(self, room_name, connection):
+        """
+        Adds a connection to a room, creating the room if needed.
+
+        Args:
+            room_name (string): name of room
+            connection (object): connection joining the room
+        """
+        with self.lock:
+            room = self.rooms.get(room_name)
+            if room is None:
+                room = self.rooms[room_name] = Room(room_name)
+            room.members[connection] = None
+            room.snapshot = None
+
+    def leave(self, room_name, connection):
+        """
+        Removes a connection from a room. A room is dropped from the registry
+        as soon as its last member leaves.
+
+        Args:
+            room_name (string): name of room
+            connection (object): connection leaving the room
+
+        Returns:
+            bool: True if the connection was in the room
+        """
+        with self.lock:
+            room = self.rooms.get(room_name)
+            if room is None or room.members.pop(connection, False) is False:
+                return False
+            if not room.members:
+                del self.rooms[room_name]
+            room.snapshot = None
+            return True
+
+    def members(self, room_name):
+        """
+        Returns:
+            tuple: connections in the room when this was called, empty if the
+                   room does not exist
+        """
+        room = self.rooms.get(room_name)
+        if room is None:
+            return ()
+        snapshot = room.snapshot
+        if snapshot is None:
+            with self.lock:
+                if room.snapshot is None:
+                    room.snapshot = tuple(room.members)
+                snapshot = room.snapshot
+        return snapshot
+
+    def items(self):
+        """
+        Returns:
+            list: list of (room name, members snapshot) tuples for every room
+        """
+        with self.lock:
+            names = list(self.rooms)
+        return [(name, self.members(name)) for name in names]
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from collections import deque
+import os
+import threading
+
+# What to do when a client's queue is full
+DROP_OLDEST = "drop-oldest"
+DISCONNECT = "disconnect"
+OVERFLOW_POLICIES = [DROP_OLDEST, DISCONNECT]
+
+# Most buffers handed to one sendmsg call
+try:
+    IOV_MAX = min(os.sysconf("SC_IOV_MAX"), 1024)
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+
+
+class SendQueue:
+    def __init__(self, maxlen=1024, policy=DROP_OLDEST):
+        """
+        Initialises a bounded queue of messages waiting to be sent to one
+        client, so a slow reader only ever holds up its own messages.
+
+        Args:
+            maxlen (int): most messages that can wait at once (default is 1024)
+            policy (string): DROP_OLDEST to make room by dropping the oldest
+                             waiting message, or DISCONNECT to refuse the new
+                             message so the client can be disconnected
+                             (default is DROP_OLDEST)
+        """
+        self.items = deque()
+        self.maxlen = maxlen
+        self.policy = policy
+        self.dropped = 0
+        self.closed = False
+        self.ready = threading.Condition()
+
+    def __len__(self):
+        """
+        Returns:
+            int: number of messages waiting
+        """
+        return len(self.items)
+
+    def put(self, message):
+        """
+        Adds a message to the queue without blocking.
+
+        Args:
+            message (bytes): encoded message
+
+        Returns:
+            bool: False if the queue is closed or full under the DISCONNECT
+                  policy, True otherwise
+        """
+        with self.ready:
+            if self.closed:
+                return False
+            if len(self.items) >= self.maxlen:
+                if self.policy == DISCONNECT:
+                    return False
+                self.items.popleft()
+                self.dropped += 1
+            self.items.append(message)
+            self.ready.notify()
+            return True
+
+    def get_batch(self, limit=IOV_MAX):
+        """
+        Blocks until there is a message to send, then takes every waiting
+        message up to limit so they can go out in one sendmsg call.
+
+        Args:
+            limit (int): most messages to take (default is IOV_MAX)
+
+        Returns:
+            list: oldest waiting messages, or None once the queue is closed
+        """
+        with self.ready:
+            while not self.items and not self.closed:
+                self.ready.wait()
+            if self.closed:
+                return None
+            return self._take(limit)
+
+    def get_batch_nowait(self, limit=IOV_MAX):
+        """
+        Args:
+            limit (int): most messages to take (default is IOV_MAX)
+
+        Returns:
+            list: oldest waiting messages, empty if there are none
+        """
+        with self.ready:
+            if self.closed:
+                return []
+            return self._take(limit)
+
+    def _take(self, limit):
+        """
+        Pops up to limit messages. Caller must hold self.ready.
+        """
+        if len(self.items) <= limit:
+            batch = list(self.items)
+            self.items.clear()
+            return batch
+        return [self.items.popleft() for _ in range(limit)]
+
+    def close(self):
+        """
+        Discards waiting messages and wakes up anything blocked in get_batch.
+        """
+        with self.ready:
+            self.closed = True
+            self.items.clear()
+            self.ready.notify_all()
+
+
+def advance(buffers, sent):
+    """
+    Drops what a sendmsg call has written from a list of buffers.
+
+    Args:
+        buffers (list): buffers that were passed to sendmsg
+        sent (int): number of bytes sendmsg wrote
+
+    Returns:
+        list: buffers still to send, the first possibly a slice of a
+              partly sent one
+    """
+    for i, buf in enumerate(buffers):
+        if sent < len(buf):
+            return [memoryview(buf)[sent:]] + buffers[i + 1:]
+        sent -= len(buf)
+    return []
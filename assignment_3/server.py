@@ -1,63 +1,142 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-from collections import defaultdict
+import argparse
 import os
 import socket
-import sys
 import threading
+import time
+
+from event_server import EventServer
+from history import MessageHistory
+from idle import IdleTracker
+from logs import log, start_logging
+from metrics import Metrics
+from protocol import (JOIN, MESSAGE, PING, PONG, OutgoingMessage, ProtocolError, decode_room, detect_decoder,
+                      encode_frame)
+from rooms import RoomRegistry
+from send_queue import DROP_OLDEST, OVERFLOW_POLICIES, SendQueue, advance
+from workers import WorkerPool
+
 
 class Server(threading.Thread):
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, queue_size=1024, overflow=DROP_OLDEST, history=None, metrics=None,
+                 idle_timeout=60):
         """
         Initialises the Server thread.
 
         Args:
             host (string): IP address of server
             port (int): port number of server
+            queue_size (int): most messages waiting to be sent to one client
+                              (default is 1024)
+            overflow (string): send_queue policy when a client's queue is full
+                               (default is DROP_OLDEST)
+            history (MessageHistory): recent messages replayed to clients
+                                      joining a room (default is a
+                                      MessageHistory with default limits)
+            metrics (Metrics): where to record live metrics (default is a
+                               Metrics with default settings)
+            idle_timeout (float): seconds without hearing from a framed
+                                  client before it is disconnected, 0 to
+                                  never disconnect (default is 60)
         """
         super().__init__()
-        self.connections = defaultdict(list)
+        self.connections = RoomRegistry()
         self.host = host
         self.port = port
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.history = history if history is not None else MessageHistory()
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.idle = IdleTracker(idle_timeout)
 
 
     def run(self):
         """
         Creates the listening socket. For each new connection, a ServerSocket thread
         is started to facilitate communications with that particular client.
+        The thread reads the room name itself so a slow client can not hold up
+        the accept loop. A reaper thread disconnects clients that have gone
+        quiet.
         """
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock.bind((self.host, self.port))
 
-        sock.listen(1)
-        print ("Listening at", sock.getsockname())
+        sock.listen(socket.SOMAXCONN)
+        log.info("Listening at %s", sock.getsockname())
+        self.metrics.start(self)
+        if self.idle.timeout > 0:
+            threading.Thread(target=self.reap, daemon=True).start()
 
         while True:
             sc, sockname = sock.accept()
-            print ("Accepted next connection from {} to {}".format(sc.getpeername(), sc.getsockname()))
-
-            # Client sends name of chatroom
-            room_name = sc.recv(1024).decode('ascii')
-            server_socket = ServerSocket(sc, sockname, room_name, self)
+            self.metrics.connection_opened()
+            log.info("Accepted next connection from %s to %s", sc.getpeername(), sc.getsockname())
+            server_socket = ServerSocket(sc, sockname, self)
+            self.idle.touch(server_socket)
             server_socket.start()
-            self.connections[room_name].append(server_socket)
-            print ("Ready to receive messages from", sc.getpeername())
+
+    def reap(self):
+        """
+        Reaper thread. Turns the idle timer wheel once a tick and disconnects
+        every client that has not been heard from for the idle timeout, which
+        wakes its thread up from recv so it can clean up.
+        """
+        while True:
+            time.sleep(self.idle.tick)
+            for connection in self.idle.expire():
+                log.info("%s has not been heard from, disconnecting", connection.sockname)
+                self.metrics.connection_idle()
+                connection.disconnect()
+
+    def add_connection(self, connection):
+        """
+        Adds a connection that has sent its room name to self.connections and
+        queues the room's recent messages for it as one write. Holding the
+        history lock means every message is either in the replay or
+        broadcast to the new connection, never both or neither.
+
+        Args:
+            connection (ServerSocket): connection to be added
+        """
+        with self.history.lock:
+            replay = self.history.replay(connection.room_name)
+            self.connections.join(connection.room_name, connection)
+            if replay:
+                connection.send(b"".join(m.encoded(connection.decoder.framed) for m in replay))
+        log.info("Ready to receive messages from %s", connection.sockname)
 
     def broadcast(self, message, source, room_name):
         """
-        Sends the given message to all clients in the same room as the source
-        except the source.
+        Queues the given message for all clients in the same room as the source
+        except the source. The message is encoded at most once for the whole
+        room.
 
         Args:
-            message (string): message to send
+            message (bytes): message payload as received
             source (tuple): tuple of host and port
             room_name (string): name of room that source is in
         """
-        for connection in self.connections[room_name]:
+        start = time.perf_counter()
+        outgoing = OutgoingMessage(message)
+        with self.history.lock:
+            self.history.append(room_name, outgoing)
+            members = self.connections.members(room_name)
+        for connection in members:
             if connection.sockname != source:
-                connection.send(message)
+                connection.send(outgoing.encoded(connection.decoder.framed))
+        self.metrics.broadcast_took(time.perf_counter() - start)
+
+    def queue_depths(self):
+        """
+        Returns:
+            dict: number of messages waiting for each client, keyed by room
+                  and then by client address
+        """
+        return {room: {connection.sockname: len(connection.queue) for connection in connections}
+                for room, connections in self.connections.items()}
 
     def remove_connection(self, connection):
         """
@@ -66,57 +145,158 @@ class Server(threading.Thread):
         Args:
             connection (ServerSocket): connection to be removed
         """
-        self.connections[connection.room_name].remove(connection)
+        self.idle.forget(connection)
+        if connection.room_name is not None:
+            self.connections.leave(connection.room_name, connection)
+
+    def close_connections(self):
+        """
+        Closes the socket of every connection in every room.
+        """
+        for room, connections in self.connections.items():
+            for connection in connections:
+                connection.sc.close()
 
 
 class ServerSocket(threading.Thread):
-    def __init__(self, sc, sockname, room_name, server):
+    def __init__(self, sc, sockname, server):
         """
         Initialises the ServerSocket thread.
 
         Arg:
             sc (socket): socket object
             sockname (tuple): tuple of host and port
-            room_name (string): name of room
             server (Server): server object where socket is running
         """
         super().__init__()
         self.sc = sc
         self.sockname = sockname
-        self.room_name = room_name
+        self.room_name = None
         self.server = server
+        self.decoder = None
+        self.queue = SendQueue(server.queue_size, server.overflow)
+        self.sender = threading.Thread(target=self.drain, daemon=True)
 
     def run(self):
         """
         Receives data from connected client and broadcasts message to all other
-        clients in that room.
+        clients in that room. The first frame names the room. Heartbeats are
+        answered, and every frame from a framed client counts as hearing from
+        it.
         If the client has left the connection, closes the connected socket and
         removes itself from the list of threads in Server.
         """
         while True:
-            message = self.sc.recv(1024).decode('ascii')
-            if message:
-                print("{} says {!r}".format(self.sockname, message))
-                self.server.broadcast(message, self.sockname, self.room_name)
-            else:
-                print ("{} has closed the connection".format(self.sockname))
-                self.sc.close()
-                server.remove_connection(self)
-                return
+            frames = self.receive()
+            if frames is None:
+                log.info("%s has closed the connection", self.sockname)
+                break
+            if self.decoder.framed:
+                self.server.idle.touch(self)
+            try:
+                self.handle_frames(frames)
+            except ProtocolError as e:
+                log.warning("%s sent a bad room name: %s", self.sockname, e)
+                break
+        self.server.metrics.connection_closed()
+        self.server.remove_connection(self)
+        self.queue.close()
+        self.sc.close()
+
+    def handle_frames(self, frames):
+        """
+        Joins the room named by the first frame, broadcasts every message
+        after that and answers heartbeats.
+
+        Args:
+            frames (list): list of (frame type, payload bytes) tuples
+
+        Raises:
+            ProtocolError: if the room name can not be decoded
+        """
+        for frame_type, payload in frames:
+            if frame_type == JOIN and self.room_name is None:
+                self.room_name = decode_room(payload)
+                self.sender.start()
+                self.server.add_connection(self)
+            elif frame_type == MESSAGE and self.room_name is not None:
+                self.server.metrics.message_in(self.room_name, len(payload))
+                if self.server.metrics.sample_log():
+                    log.info("%s says %r", self.sockname, payload)
+                self.server.broadcast(payload, self.sockname, self.room_name)
+            elif frame_type == PING:
+                self.send(encode_frame(PONG, payload))
+
+    def receive(self):
+        """
+        Blocks until the client sends more data and decodes it, picking framed
+        or legacy decoding from the first byte the client sends. Legacy
+        clients can not send heartbeats, so they are left to TCP keepalive
+        instead of the idle timer wheel.
+
+        Returns:
+            list: list of (frame type, payload bytes) tuples, or None if the
+                  client has closed the connection or sent a bad frame
+        """
+        try:
+            if self.decoder is None:
+                self.decoder = detect_decoder(self.sc)
+                if self.decoder is None:
+                    return None
+                if not self.decoder.framed:
+                    self.server.idle.keep_alive(self, self.sc)
+            if not self.decoder.read_from(self.sc):
+                return None
+            return self.decoder.frames()
+        except (OSError, ProtocolError):
+            return None
 
     def send(self, message):
         """
-        Sends given message to connected server.
+        Queues given message to be sent to the connected client by the sender
+        thread. If the queue is full under the DISCONNECT policy, the client
+        is too slow to keep up and is disconnected.
 
         Args:
-            message (string): message to send
+            message (bytes): message encoded for this client
+        """
+        if not self.queue.put(message) and not self.queue.closed:
+            log.warning("%s is not keeping up, disconnecting", self.sockname)
+            self.disconnect()
+
+    def drain(self):
+        """
+        Sender thread. Writes every waiting message to the client with one
+        sendmsg call, so a full TCP window only blocks this client.
+        """
+        while True:
+            batch = self.queue.get_batch()
+            if batch is None:
+                return
+            self.server.metrics.sent(self.room_name, len(batch), sum(len(message) for message in batch))
+            try:
+                while batch:
+                    batch = advance(batch, self.sc.sendmsg(batch))
+            except OSError:
+                self.disconnect()
+                return
+
+    def disconnect(self):
+        """
+        Shuts the socket down so the receiving thread wakes up and removes
+        this connection.
         """
-        self.sc.sendall(message.encode('ascii'))
+        self.queue.close()
+        try:
+            self.sc.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
 
 def exit(server):
     """
-    Listens for 'q' to quit server.
+    Listens for 'q' to quit server, or 'queues' to print how many messages
+    are waiting to be sent to each client.
 
     Args:
         server (Server): server object to listen to
@@ -125,26 +305,55 @@ def exit(server):
         ipt = input('')
         if ipt == 'q':
             print ("Closing all connections...")
-            for room in server.connections:
-                for connection in server.connections[room]:
-                    connection.sc.close()
+            server.close_connections()
             print ("Shutting down the server...")
             os._exit(0)
+        elif ipt == 'queues':
+            for room, depths in server.queue_depths().items():
+                for sockname, depth in depths.items():
+                    print ("{} {}: {} waiting".format(room, sockname, depth))
 
 
 if __name__ == "__main__":
-    if len(sys.argv) == 1:
-        ip = "0.0.0.0"
-        port = 8080
-    elif len(sys.argv) == 2:
-        if "." in sys.argv.split(" ")[1]:
-            ip = sys.argv.split(" ")[1]
-            port = 8080
-    else:
-        ip = sys.argv[1]
-        port = int(sys.argv[2])
+    parser = argparse.ArgumentParser(description="Multi-room chat server.")
+    parser.add_argument("host", nargs="?", default="0.0.0.0")
+    parser.add_argument("port", nargs="?", type=int, default=8080)
+    parser.add_argument("--mode", choices=["threaded", "event"], default="threaded",
+                        help="one thread per client, or a single event loop for all clients")
+    parser.add_argument("--queue-size", type=int, default=1024,
+                        help="most messages waiting to be sent to one client")
+    parser.add_argument("--overflow", choices=OVERFLOW_POLICIES, default=DROP_OLDEST,
+                        help="what to do when a client's queue is full")
+    parser.add_argument("--history", type=int, default=50,
+                        help="recent messages per room replayed to new members, 0 to turn off")
+    parser.add_argument("--history-bytes", type=int, default=65536,
+                        help="most bytes of history kept per room")
+    parser.add_argument("--history-memory", type=int, default=16 * 1024 * 1024,
+                        help="most bytes of history kept over all rooms, shared evenly between workers")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes sharing the port, each running an event loop")
+    parser.add_argument("--stats-port", type=int, default=0,
+                        help="localhost port serving live metrics as JSON, each worker uses the next port")
+    parser.add_argument("--stats-file", help="file to write metrics snapshots to, suffixed with the worker number")
+    parser.add_argument("--stats-interval", type=float, default=5,
+                        help="seconds between metrics snapshots")
+    parser.add_argument("--idle-timeout", type=float, default=60,
+                        help="seconds without a heartbeat before a framed client is disconnected, 0 to turn off")
+    parser.add_argument("--log-sample", type=int, default=100,
+                        help="log one in this many messages, 0 to log none")
+    args = parser.parse_args()
 
-    server = Server(ip, port)
+    start_logging()
+    history = MessageHistory(args.history, args.history_bytes, args.history_memory)
+    metrics = Metrics(args.stats_interval, args.stats_file, args.stats_port, args.log_sample)
+    if args.workers > 1:
+        server = WorkerPool(args.host, args.port, args.workers, args.queue_size, args.overflow, history, metrics,
+                            args.idle_timeout)
+    elif args.mode == "event":
+        server = EventServer(args.host, args.port, args.queue_size, args.overflow, history, metrics,
+                             args.idle_timeout)
+    else:
+        server = Server(args.host, args.port, args.queue_size, args.overflow, history, metrics, args.idle_timeout)
     server.start()
 
     exit = threading.Thread(target = exit, args = (server,))
@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import array
+from bisect import bisect
+import hashlib
+import json
+import multiprocessing
+from multiprocessing.connection import wait
+import os
+import selectors
+import socket
+import struct
+import threading
+import time
+
+from event_server import EventServer, EventSocket
+from history import MessageHistory
+from logs import log, start_logging
+from protocol import JOIN, FrameDecoder, LegacyDecoder, encode_frame
+from send_queue import DROP_OLDEST
+
+# Handoff datagrams are a 4 byte length of the JSON metadata, the metadata and
+# whatever the client sent after its room name. The client's socket travels
+# alongside as SCM_RIGHTS ancillary data.
+HANDOFF = struct.Struct(">I")
+MAX_HANDOFF = 65536
+FD_SIZE = array.array("i").itemsize
+# A worker that dies sooner than this after starting is restarted only after
+# this many seconds, so a worker that crashes straight away does not spin
+RESTART_DELAY = 1.0
+
+
+class HashRing:
+    def __init__(self, nodes, replicas=64):
+        """
+        Initialises a consistent hash ring. Every process builds the same ring
+        from the same nodes, so they all agree which worker owns a room
+        without talking to each other.
+
+        Args:
+            nodes (list): node ids, here worker indexes
+            replicas (int): points on the ring per node (default is 64)
+        """
+        self.points = sorted((ring_hash("{}:{}".format(node, i)), node)
+                             for node in nodes for i in range(replicas))
+        self.hashes = [point[0] for point in self.points]
+
+    def owner(self, key):
+        """
+        Args:
+            key (string): key to place, here a room name
+
+        Returns:
+            node id of the first point clockwise from the key's hash
+        """
+        i = bisect(self.hashes, ring_hash(key)) % len(self.points)
+        return self.points[i][1]
+
+
+def ring_hash(key):
+    """
+    Stable 64 bit hash of a string. Python's own hash is salted per process,
+    so it can not be used to agree on owners across workers.
+
+    Args:
+        key (string): string to hash
+
+    Returns:
+        int: hash of key
+    """
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], "big")
+
+
+class ShardServer(EventServer):
+
+    def __init__(self, index, inboxes, host, port, queue_size=1024, overflow=DROP_OLDEST, history=None,
+                 metrics=None, idle_timeout=60, listener=None):
+        """
+        Initialises one worker of a WorkerPool. Each worker runs an event loop
+        and owns the rooms the hash ring gives it. A client that names a room
+        owned by another worker is handed to that worker over the IPC bus, so
+        every member of a room is served by a single event loop and sees its
+        messages in the same order as with one process.
+
+        Args:
+            index (int): this worker's index
+            inboxes (list): one (read end, write end) Unix datagram socket pair
+                            per worker
+            host (string): IP address of server
+            port (int): port number of server
+            queue_size (int): most messages waiting to be sent to one client
+                              (default is 1024)
+            overflow (string): send_queue policy when a client's queue is full
+                               (default is DROP_OLDEST)
+            history (MessageHistory): recent messages replayed to clients
+                                      joining a room (default is None)
+            metrics (Metrics): where to record live metrics (default is None)
+            idle_timeout (float): seconds without hearing from a framed
+                                  client before it is disconnected, 0 to
+                                  never disconnect (default is 60)
+            listener (socket): listening socket shared by all workers, or None
+                               for each worker to bind its own with
+                               SO_REUSEPORT (default is None)
+        """
+        super().__init__(host, port, queue_size, overflow, history, metrics, idle_timeout)
+        self.index = index
+        self.inboxes = inboxes
+        self.ring = HashRing(range(len(inboxes)))
+        self.listener = listener
+
+    def run(self):
+        """
+        Listens for handed off clients as well as new connections. Each
+        worker reports its own metrics, on the next stats port up and to the
+        stats file suffixed with its index.
+        """
+        if self.metrics.stats_port:
+            self.metrics.stats_port += self.index
+        if self.metrics.stats_file:
+            self.metrics.stats_file = "{}.{}".format(self.metrics.stats_file, self.index)
+        inbox = self.inboxes[self.index][0]
+        inbox.setblocking(False)
+        self.selector.register(inbox, selectors.EVENT_READ, self.adopt)
+        parent = multiprocessing.parent_process()
+        if parent is not None:
+            self.selector.register(parent.sentinel, selectors.EVENT_READ, self.orphaned)
+        super().run()
+
+    def orphaned(self, sentinel, mask):
+        """
+        Exits when the supervisor has died, which it does when the server
+        process has gone, so killing the server does not leave workers holding
+        the port.
+
+        Args:
+            sentinel (int): handle that becomes ready when the parent exits
+            mask (int): selector events that are ready
+        """
+        log.warning("Supervisor has exited, stopping worker %d", self.index)
+        os._exit(1)
+
+    def listen(self):
+        """
+        Returns:
+            socket: shared listening socket, or a new one bound with
+                    SO_REUSEPORT so the kernel spreads connections over workers
+        """
+        if self.listener is not None:
+            return self.listener
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(socket.SOMAXCONN)
+        return sock
+
+    def join(self, connection, rest):
+        """
+        Adds a connection to its room if this worker owns the room, otherwise
+        hands it to the owner.
+
+        Args:
+            connection (EventSocket): connection that has named its room
+            rest (list): frames received after the room name, passed on to
+                         the owner
+
+        Returns:
+            bool: True if the connection stays on this worker
+        """
+        owner = self.ring.owner(connection.room_name)
+        if owner == self.index:
+            return super().join(connection, rest)
+        self.hand_off(connection, owner, rest)
+        return False
+
+    def hand_off(self, connection, owner, rest):
+        """
+        Sends a connection's socket, room and unprocessed input to the worker
+        that owns its room, then closes this worker's copy of the socket. The
+        bus never blocks, so if the owner's inbox is full because it is stuck
+        or restarting, the client is disconnected instead.
+
+        Args:
+            connection (EventSocket): connection to move
+            owner (int): index of worker that owns the room
+            rest (list): frames received after the room name
+        """
+        meta = json.dumps({"room": connection.room_name, "framed": connection.decoder.framed}).encode('utf-8')
+        data = b""
+        if connection.decoder.framed:
+            data = b"".join(encode_frame(t, p) for t, p in rest) + bytes(connection.decoder.pending)
+        message = HANDOFF.pack(len(meta)) + meta + data
+        if len(message) > MAX_HANDOFF:
+            log.warning("%s sent too much to hand off, disconnecting", connection.sockname)
+        else:
+            fds = array.array("i", [connection.sc.fileno()])
+            try:
+                self.inboxes[owner][1].sendmsg([message], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+            except OSError as e:
+                log.warning("Could not hand %s to worker %d (%s), disconnecting", connection.sockname, owner, e)
+        connection.close()
+
+    def adopt(self, inbox, mask):
+        """
+        Takes over every connection other workers have handed to this one and
+        processes whatever the client sent before the handoff.
+
+        Args:
+            inbox (socket): this worker's end of the IPC bus
+            mask (int): selector events that are ready
+        """
+        while True:
+            try:
+                message, ancdata, flags, address = inbox.recvmsg(MAX_HANDOFF, socket.CMSG_LEN(FD_SIZE))
+            except (BlockingIOError, InterruptedError):
+                return
+            fds = array.array("i")
+            for level, kind, fd_data in ancdata:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                    fds.frombytes(fd_data[:len(fd_data) - len(fd_data) % FD_SIZE])
+            if not fds:
+                continue
+            meta_len = HANDOFF.unpack_from(message)[0]
+            meta = json.loads(message[HANDOFF.size:HANDOFF.size + meta_len])
+            data = message[HANDOFF.size + meta_len:]
+
+            sc = socket.socket(fileno=fds[0])
+            sc.setblocking(False)
+            try:
+                sockname = sc.getpeername()
+            except OSError:
+                sc.close()
+                continue
+            self.metrics.connection_opened()
+            connection = EventSocket(sc, sockname, self)
+            if meta["framed"]:
+                connection.decoder = FrameDecoder()
+            else:
+                connection.decoder = LegacyDecoder()
+                connection.decoder.joined = True
+            if data:
+                connection.decoder.feed(data)
+            self.selector.register(sc, selectors.EVENT_READ, connection.handle)
+            if connection.decoder.framed:
+                self.idle.touch(connection)
+            connection.handle_frames([(JOIN, meta["room"].encode('ascii'))] + connection.decoder.frames())
+
+
+def run_worker(index, inboxes, host, port, queue_size, overflow, history, metrics, idle_timeout, listener):
+    """
+    Entry point of each worker process. The log listener thread does not
+    survive the fork, so each worker starts its own.
+    """
+    start_logging()
+    ShardServer(index, inboxes, host, port, queue_size, overflow, history, metrics, idle_timeout, listener).run()
+
+
+def supervise(workers, worker_args):
+    """
+    Entry point of the supervisor process. Forks the workers and forks a new
+    one in place of any worker that exits, on the same inbox, so it picks up
+    the clients handed to it meanwhile. Returns once the server process has
+    gone, which stops the workers too.
+
+    Args:
+        workers (int): number of worker processes
+        worker_args (tuple): arguments for run_worker after the index
+    """
+    start_logging()
+    context = multiprocessing.get_context("fork")
+    parent = multiprocessing.parent_process()
+    processes = {}
+
+    def spawn(index):
+        process = context.Process(target=run_worker, args=(index,) + worker_args, daemon=True)
+        process.start()
+        processes[process.sentinel] = (index, process, time.monotonic())
+
+    for index in range(workers):
+        spawn(index)
+    while True:
+        ready = wait(list(processes) + [parent.sentinel])
+        if parent.sentinel in ready:
+            return
+        for sentinel in ready:
+            index, process, started = processes.pop(sentinel)
+            process.join()
+            log.warning("Worker %d exited with code %s, restarting it", index, process.exitcode)
+            if time.monotonic() - started < RESTART_DELAY:
+                time.sleep(RESTART_DELAY)
+            spawn(index)
+
+
+class WorkerPool(threading.Thread):
+
+    def __init__(self, host, port, workers, queue_size=1024, overflow=DROP_OLDEST, history=None, metrics=None,
+                 idle_timeout=60):
+        """
+        Initialises the WorkerPool thread, which runs the chat server as
+        several processes so it is not limited to one core by the GIL.
+
+        Args:
+            host (string): IP address of server
+            port (int): port number of server
+            workers (int): number of worker processes
+            queue_size (int): most messages waiting to be sent to one client
+                              (default is 1024)
+            overflow (string): send_queue policy when a client's queue is full
+                               (default is DROP_OLDEST)
+            history (MessageHistory): history limits, copied into each
+                                      worker when it is forked. Each worker
+                                      keeps the history of the rooms it
+                                      owns, so they get an even share of
+                                      max_total_bytes (default is None)
+            metrics (Metrics): metrics settings, copied into each worker when
+                               it is forked (default is None)
+            idle_timeout (float): seconds without hearing from a framed
+                                  client before a worker disconnects it, 0 to
+                                  never disconnect (default is 60)
+        """
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.history = history
+        if history is not None:
+            self.history = MessageHistory(history.max_messages, history.max_bytes,
+                                          history.max_total_bytes // workers)
+        self.metrics = metrics
+        self.idle_timeout = idle_timeout
+        self.supervisor = None
+        self.closing = False
+
+    def start(self):
+        """
+        Creates the IPC bus and forks the supervisor, which forks and
+        restarts the workers, then starts the thread that waits for it.
+        Forking happens in the calling thread, before the console thread can
+        be blocked in input() holding the stdin lock that each forked process
+        needs to close its stdin, and the supervisor has no console of its
+        own. Workers bind their own sockets with SO_REUSEPORT where it is
+        available, and otherwise all accept from one socket made here.
+        """
+        context = multiprocessing.get_context("fork")
+        inboxes = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(self.workers)]
+        for inbox in inboxes:
+            inbox[1].setblocking(False)
+        listener = None
+        if not hasattr(socket, "SO_REUSEPORT"):
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((self.host, self.port))
+            listener.listen(socket.SOMAXCONN)
+        worker_args = (inboxes, self.host, self.port, self.queue_size, self.overflow, self.history,
+                       self.metrics, self.idle_timeout, listener)
+        self.supervisor = context.Process(target=supervise, args=(self.workers, worker_args))
+        self.supervisor.start()
+        super().start()
+
+    def run(self):
+        """
+        Waits for the supervisor, and shuts the server down if it exits
+        without being asked to.
+        """
+        self.supervisor.join()
+        if not self.closing:
+            log.error("Worker supervisor exited with code %s, shutting down", self.supervisor.exitcode)
+            os._exit(1)
+
+    def queue_depths(self):
+        """
+        Returns:
+            dict: always empty, queues live in the worker processes
+        """
+        return {}
+
+    def close_connections(self):
+        """
+        Stops the supervisor. Its workers notice it has gone and exit, which
+        closes all of their connections.
+        """
+        self.closing = True
+        self.supervisor.terminate()
@@ -1,12 +1,146 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from flask import Flask, jsonify, render_template, request
+from flask import Flask, Response, abort, render_template, request, url_for
 
 import csv
+from functools import lru_cache
+import gzip
+import hashlib
+import json
+import os
+import sys
+import threading
+
+# networking.py sits next to this file in the docker image, and in
+# assignment_1 when run from the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "assignment_1"))
+from networking import IPAddress, Supernet
 
 app = Flask(__name__)
 
+# Path of allegiances csv file, can be overridden to run outside docker
+ALLEGIANCE_CSV = os.environ.get("ALLEGIANCE_CSV", "/opt/allegiance.csv")
+ALLEGIANCE_KEYS = ["Name", "Affiliation", "Allegiance"]
+# Columns indexed when the file is loaded, other columns are filtered by
+# scanning every row
+INDEXED_KEYS = ["Affiliation", "Allegiance"]
+PER_PAGE = 500
+MAX_PER_PAGE = 5000
+# Rows written per chunk of a streamed response
+STREAM_CHUNK = 1000
+# Same output as jsonify, one encoder shared by every row
+encode_json = json.JSONEncoder(sort_keys=True, separators=(",", ":")).encode
+# Most items in one request to the subnet calculator endpoints, and most
+# results remembered for each of them
+MAX_BATCH = 100000
+RESULT_CACHE_SIZE = 65536
+
+
+class Allegiances:
+    def __init__(self, path):
+        """
+        Reads the allegiances csv file once and builds everything needed to
+        serve it: the rows, each row encoded as JSON, the JSON response body, a
+        gzipped copy of the body, an ETag and an index of the rows by each of
+        INDEXED_KEYS. Pages and filtered results are joined from the encoded
+        rows, so no request has to encode JSON again.
+
+        Args:
+            path (string): path of csv file
+        """
+        stat = os.stat(path)
+        self.stamp = (stat.st_mtime_ns, stat.st_size)
+        self.last_modified = stat.st_mtime
+        with open(path, "r", newline="") as csvfile:
+            reader = csv.reader(csvfile)
+            next(reader, None)
+            self.rows = [tuple(row) for row in reader]
+        self.encoded = [encode_json(dict(zip(ALLEGIANCE_KEYS, row))).encode("utf-8") for row in self.rows]
+        self.body = b"[" + b",".join(self.encoded) + b"]"
+        gzipped = gzip.compress(self.body, compresslevel=6)
+        self.gzipped = gzipped if len(gzipped) < len(self.body) else None
+        self.etag = hashlib.sha1(self.body).hexdigest()
+        # column -> value -> positions of rows with that value
+        self.index = {}
+        for key in INDEXED_KEYS:
+            i = ALLEGIANCE_KEYS.index(key)
+            index = self.index[key] = {}
+            for position, row in enumerate(self.rows):
+                index.setdefault(row[i] if i < len(row) else "", []).append(position)
+
+    def select(self, filters):
+        """
+        Finds the rows matching every filter. The smallest matching index
+        entry is used to narrow the rows down before checking the rest, so a
+        single indexed filter costs one lookup.
+
+        Args:
+            filters (dict): column name -> value rows must have
+
+        Returns:
+            sequence: positions of matching rows, in file order
+        """
+        if not filters:
+            return range(len(self.rows))
+        indexed = [(len(self.index[key].get(value, ())), key) for key, value in filters.items()
+                   if key in self.index]
+        if indexed:
+            narrowest = min(indexed)[1]
+            positions = self.index[narrowest].get(filters[narrowest], [])
+            filters = {key: value for key, value in filters.items() if key != narrowest}
+        else:
+            positions = range(len(self.rows))
+        if not filters:
+            return positions
+        return [position for position in positions
+                if all(column(self.rows[position], key) == value for key, value in filters.items())]
+
+
+def column(row, key):
+    """
+    Args:
+        row (tuple): row of csv file
+        key (string): one of ALLEGIANCE_KEYS
+
+    Returns:
+        string: value of the column, empty if the row is too short
+    """
+    i = ALLEGIANCE_KEYS.index(key)
+    return row[i] if i < len(row) else ""
+
+
+class AllegianceCache:
+    def __init__(self, path):
+        """
+        Keeps the allegiances csv file loaded between requests and loads it
+        again only when its modification time or size changes.
+
+        Args:
+            path (string): path of csv file
+        """
+        self.path = path
+        self.loaded = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        """
+        Returns:
+            Allegiances: contents of the file as it is now
+        """
+        stat = os.stat(self.path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        loaded = self.loaded
+        if loaded is None or loaded.stamp != stamp:
+            with self.lock:
+                loaded = self.loaded
+                if loaded is None or loaded.stamp != stamp:
+                    loaded = self.loaded = Allegiances(self.path)
+        return loaded
+
+
+allegiances = AllegianceCache(ALLEGIANCE_CSV)
+
 
 @app.route("/")
 def homepage():
@@ -45,22 +179,65 @@ def formtest():
 @app.route("/allegiances")
 def allegiances_json():
     """
-    Returns json of allegiances csv file.
-    """
-    csvfile = open("/opt/allegiance.csv", "r")
-    reader = csv.reader(csvfile)
-    keys = ["Name", "Affiliation", "Allegiance"]
-    allegiances = []
-    i = 0
-    for row in reader:
-        if i != 0:
-            dict = {}
-            for key, value in zip(keys, row):
-                dict[key] = value
-            allegiances.append(dict)
+    Returns json of allegiances csv file. The JSON is only built again when
+    the file changes. Clients that already have it get a 304 Not Modified,
+    and clients that accept gzip get it compressed.
+
+    Any column given as a query parameter, such as ?Affiliation=Jedi, filters
+    the rows. Giving page and optionally per_page returns one page of rows
+    with the total, and format=ndjson streams the rows as one JSON object
+    per line.
+    """
+    loaded = allegiances.get()
+    filters = {key: request.args[key] for key in ALLEGIANCE_KEYS if key in request.args}
+    ndjson = request.args.get("format") == "ndjson"
+    paged = "page" in request.args or "per_page" in request.args
+    if filters or ndjson or paged:
+        positions = loaded.select(filters)
+        if paged:
+            page = max(1, request.args.get("page", 1, type=int))
+            per_page = min(max(1, request.args.get("per_page", PER_PAGE, type=int)), MAX_PER_PAGE)
+            pages = (len(positions) + per_page - 1) // per_page
+            meta = {"page": page, "pages": pages, "per_page": per_page, "total": len(positions),
+                    "next": url_for("allegiances_json", **dict(request.args, page=page + 1, per_page=per_page))
+                    if page < pages else None}
+            positions = positions[(page - 1) * per_page:page * per_page]
+        if ndjson:
+            response = Response(stream_rows(loaded, positions), mimetype="application/x-ndjson")
+        elif paged:
+            head = json.dumps(meta, sort_keys=True, separators=(",", ":")).encode("utf-8")
+            response = Response(head[:-1] + b',"rows":[' + b",".join(loaded.encoded[p] for p in positions) + b"]}",
+                                mimetype="application/json")
         else:
-            i += 1
-    return jsonify(allegiances)
+            response = Response(b"[" + b",".join(loaded.encoded[p] for p in positions) + b"]",
+                                mimetype="application/json")
+        response.set_etag(loaded.etag)
+    elif loaded.gzipped is not None and request.accept_encodings["gzip"]:
+        response = Response(loaded.gzipped, mimetype="application/json")
+        response.headers["Content-Encoding"] = "gzip"
+        response.set_etag(loaded.etag + "-gzip")
+    else:
+        response = Response(loaded.body, mimetype="application/json")
+        response.set_etag(loaded.etag)
+    response.vary.add("Accept-Encoding")
+    response.last_modified = loaded.last_modified
+    return response.make_conditional(request)
+
+
+def stream_rows(loaded, positions):
+    """
+    Yields rows as newline delimited JSON, STREAM_CHUNK rows at a time.
+
+    Args:
+        loaded (Allegiances): loaded file to take rows from
+        positions (sequence): positions of rows to send
+
+    Yields:
+        bytes: chunk of lines
+    """
+    for start in range(0, len(positions), STREAM_CHUNK):
+        chunk = positions[start:start + STREAM_CHUNK]
+        yield b"\n".join(loaded.encoded[p] for p in chunk) + b"\n"
 
 
 @app.route("/allegiancedashboard")
@@ -72,5 +249,223 @@ def allegiances_html():
     return render_template("dashboard.html")
 
 
+@app.route("/ipclasses", methods=["POST"])
+def ip_classes():
+    """
+    Returns the class stats of each address in a JSON body of the form
+    {"addresses": ["136.206.18.7", ...]}.
+    """
+    addresses = batch_items("addresses")
+    return batch_response(addresses, lambda address: class_stats(address) if isinstance(address, str)
+                          else invalid(address, "not an IPv4 address in decimal dot notation"))
+
+
+@app.route("/subnets", methods=["POST"])
+def subnets():
+    """
+    Returns the subnet stats of each address and mask in a JSON body of the
+    form {"subnets": [{"address": "192.168.10.0", "mask": "255.255.255.192"},
+    ...]}.
+    """
+    items = batch_items("subnets")
+    keys = ("address", "mask")
+    return batch_response(items, lambda item: subnet_stats(item["address"], item["mask"])
+                          if isinstance(item, dict) and all(isinstance(item.get(key), str) for key in keys)
+                          else invalid(item, "expected an address and mask"))
+
+
+@app.route("/supernets", methods=["POST"])
+def supernets():
+    """
+    Returns the supernet stats of each list of addresses in a JSON body of the
+    form {"supernets": [["205.100.0.0", "205.100.1.0", ...], ...]}.
+    """
+    items = batch_items("supernets")
+    return batch_response(items, lambda item: supernet_stats(tuple(item))
+                          if isinstance(item, list) and item and all(isinstance(address, str) for address in item)
+                          else invalid(item, "expected a list of addresses"))
+
+
+def batch_items(key):
+    """
+    Args:
+        key (string): key of the list in the JSON request body
+
+    Returns:
+        list: items to calculate
+
+    Raises:
+        HTTPException: 400 Bad Request if the body has no such list or it is
+                       longer than MAX_BATCH
+    """
+    body = request.get_json(silent=True)
+    items = body.get(key) if isinstance(body, dict) else None
+    if not isinstance(items, list):
+        abort(400, description="Expected a JSON object with a list of {}".format(key))
+    if len(items) > MAX_BATCH:
+        abort(400, description="At most {} {} per request".format(MAX_BATCH, key))
+    return items
+
+
+def batch_response(items, calculate):
+    """
+    Calculates the result for each item, as a JSON array, or as newline
+    delimited JSON with ?format=ndjson. Batches of more than STREAM_CHUNK
+    items are streamed back as they are calculated.
+
+    Args:
+        items (list): items from the request
+        calculate (callable): returns the encoded JSON result of one item
+
+    Returns:
+        Response: results in the same order as items
+    """
+    ndjson = request.args.get("format") == "ndjson"
+    mimetype = "application/x-ndjson" if ndjson else "application/json"
+    if len(items) <= STREAM_CHUNK:
+        results = [calculate(item) for item in items]
+        if ndjson:
+            return Response(b"".join(result + b"\n" for result in results), mimetype=mimetype)
+        return Response(b"[" + b",".join(results) + b"]", mimetype=mimetype)
+
+    def generate():
+        for start in range(0, len(items), STREAM_CHUNK):
+            results = [calculate(item) for item in items[start:start + STREAM_CHUNK]]
+            if ndjson:
+                yield b"".join(result + b"\n" for result in results)
+            else:
+                yield (b"[" if start == 0 else b",") + b",".join(results)
+        if not ndjson:
+            yield b"]"
+    return Response(generate(), mimetype=mimetype)
+
+
+@lru_cache(maxsize=RESULT_CACHE_SIZE)
+def class_stats(address):
+    """
+    Args:
+        address (string): IP address in decimal dot notation
+
+    Returns:
+        bytes: encoded JSON of the address's class stats, or of an error
+    """
+    if not is_address(address):
+        return invalid(address, "not an IPv4 address in decimal dot notation")
+    if not has_class(address):
+        return invalid(address, "not in any address class")
+    ip = IPAddress(address)
+    return encode_json({
+        "address": address,
+        "class": ip.ip_class,
+        "networks": ip.num_networks,
+        "hosts": ip.num_hosts,
+        "first_address": ip.first_address,
+        "last_address": ip.last_address,
+    }).encode("utf-8")
+
+
+@lru_cache(maxsize=RESULT_CACHE_SIZE)
+def subnet_stats(address, mask):
+    """
+    Args:
+        address (string): IP address in decimal dot notation
+        mask (string): subnet mask in decimal dot notation
+
+    Returns:
+        bytes: encoded JSON of the subnet's stats, or of an error
+    """
+    if not is_address(address):
+        return invalid({"address": address, "mask": mask}, "not an IPv4 address in decimal dot notation")
+    if not has_class(address):
+        return invalid({"address": address, "mask": mask}, "not in any address class")
+    if not is_mask(mask):
+        return invalid({"address": address, "mask": mask}, "not a subnet mask in decimal dot notation")
+    ip = IPAddress(address, mask)
+    return encode_json({
+        "address": address,
+        "mask": mask,
+        "cidr": ip.cidr_notation,
+        "subnets": ip.num_subnets,
+        "addressable_hosts": ip.addressable_hosts,
+        "valid_subnets": ip.valid_subnets,
+        "broadcast_addresses": ip.broadcast_addresses,
+        "first_addresses": ip.subnet_firsts,
+        "last_addresses": ip.subnet_lasts,
+    }).encode("utf-8")
+
+
+@lru_cache(maxsize=RESULT_CACHE_SIZE)
+def supernet_stats(addresses):
+    """
+    Args:
+        addresses (tuple): IP addresses in decimal dot notation
+
+    Returns:
+        bytes: encoded JSON of the supernet's stats, or of an error
+    """
+    if not all(is_address(address) for address in addresses):
+        return invalid(list(addresses), "not a list of IPv4 addresses in decimal dot notation")
+    if not all(has_class(address) for address in addresses):
+        return invalid(list(addresses), "not all in an address class")
+    supernet = Supernet(list(addresses))
+    return encode_json({
+        "addresses": list(addresses),
+        "cidr": supernet.supernet_cidr_notation,
+        "network_mask": supernet.network_mask,
+    }).encode("utf-8")
+
+
+def invalid(item, reason):
+    """
+    Args:
+        item: item from the request that could not be calculated
+        reason (string): why not
+
+    Returns:
+        bytes: encoded JSON of the error
+    """
+    return encode_json({"input": item, "error": reason}).encode("utf-8")
+
+
+def is_address(address):
+    """
+    Args:
+        address (string): string to check
+
+    Returns:
+        bool: True if address is an IPv4 address in decimal dot notation
+    """
+    parts = address.split(".")
+    return len(parts) == 4 and all(part.isascii() and part.isdigit() and len(part) <= 3 and int(part) <= 255
+                                   for part in parts)
+
+
+def has_class(address):
+    """
+    Args:
+        address (string): IPv4 address in decimal dot notation
+
+    Returns:
+        bool: True if the address is in one of the classes A to E, which
+              networking.py can calculate. The class comes from the first
+              byte, which has no 0 bit to find it by when it is 255.
+    """
+    return int(address.split(".")[0]) < 255
+
+
+def is_mask(mask):
+    """
+    Args:
+        mask (string): string to check
+
+    Returns:
+        bool: True if mask is a subnet mask with at least one host bit
+    """
+    if not is_address(mask):
+        return False
+    bits = "".join("{0:08b}".format(int(part)) for part in mask.split("."))
+    return "0" in bits and "01" not in bits
+
+
 if __name__ == "__main__":
     app.run()
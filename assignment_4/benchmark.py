@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import cProfile
+import http.client
+import io
+import json
+import logging
+import os
+import platform
+import pstats
+import sys
+import threading
+import time
+from urllib.parse import urlencode
+
+from werkzeug.serving import make_server
+
+import assignment_4
+
+# name, method, path and form data of every route benchmarked
+ROUTES = [
+    ("/", "GET", "/", None),
+    ("/showname", "GET", "/showname?username=benchmark", None),
+    ("/formtest", "GET", "/formtest", None),
+    ("/formtest POST", "POST", "/formtest", {"name": "benchmark"}),
+    ("/allegiances", "GET", "/allegiances", None),
+    ("/allegiancedashboard", "GET", "/allegiancedashboard", None),
+]
+TARGETS = ["test-client", "server"]
+
+
+class TestClientTarget:
+    def __init__(self, app):
+        """
+        Sends requests straight to the app through Flask's test client, which
+        measures the app without any networking.
+
+        Args:
+            app (Flask): app to benchmark
+        """
+        self.app = app
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def sender(self):
+        """
+        Returns:
+            callable: sends one request, returns its status code. Each thread
+                      gets its own test client.
+        """
+        client = self.app.test_client()
+
+        def send(method, path, data):
+            response = client.open(path, method=method, data=data)
+            response.close()
+            return response.status_code
+        return send
+
+
+class ServerTarget:
+    def __init__(self, app):
+        """
+        Serves the app from a threaded werkzeug server on a free local port,
+        the same server app.run() uses, and sends real HTTP requests to it.
+
+        Args:
+            app (Flask): app to benchmark
+        """
+        self.server = make_server("127.0.0.1", 0, app, threaded=True)
+        self.port = self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def sender(self):
+        """
+        Returns:
+            callable: sends one request on a new connection, as the server
+                      closes every connection after one request, and returns
+                      its status code
+        """
+        def send(method, path, data):
+            connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+            try:
+                if data is None:
+                    connection.request(method, path)
+                else:
+                    connection.request(method, path, urlencode(data),
+                                       {"Content-Type": "application/x-www-form-urlencoded"})
+                response = connection.getresponse()
+                response.read()
+                return response.status
+            finally:
+                connection.close()
+        return send
+
+
+class ProfilerMiddleware:
+    def __init__(self, wsgi_app):
+        """
+        Profiles every request passed to wsgi_app and adds the profile to the
+        totals of its method and path, so the hottest call stacks of each
+        route can be reported after a run. Profiling slows requests down, so
+        throughput measured with it on is not comparable. Only one profiler
+        can run at a time on Python 3.12 and later, so concurrent requests
+        that start while another is being profiled are counted and skipped.
+
+        Args:
+            wsgi_app (callable): WSGI app to profile
+        """
+        self.wsgi_app = wsgi_app
+        self.stats = {}
+        self.skipped = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        route = "{} {}".format(environ["REQUEST_METHOD"], environ["PATH_INFO"])
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already running in this interpreter
+            with self.lock:
+                self.skipped[route] = self.skipped.get(route, 0) + 1
+            return self.wsgi_app(environ, start_response)
+        iterable = None
+        try:
+            iterable = self.wsgi_app(environ, start_response)
+            body = list(iterable)
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+            profile.disable()
+            with self.lock:
+                if route in self.stats:
+                    self.stats[route].add(profile)
+                else:
+                    self.stats[route] = pstats.Stats(profile)
+        return body
+
+    def report(self, top, profile_dir=None):
+        """
+        Args:
+            top (int): number of functions to list for each route
+            profile_dir (string): directory to also write each route's
+                                  profile to, for other tools to load
+                                  (default is None)
+
+        Returns:
+            string: the functions with the most cumulative and own time for
+                    each route, and what called the hottest of them, with the
+                    number of its requests that were not profiled
+        """
+        output = io.StringIO()
+        for route in sorted(set(self.stats) | set(self.skipped)):
+            skipped = self.skipped.get(route, 0)
+            output.write("==== {} ({} requests not profiled) ====\n".format(route, skipped))
+            stats = self.stats.get(route)
+            if stats is None:
+                continue
+            if profile_dir:
+                name = route.replace(" ", "_").replace("/", "_").strip("_") or "root"
+                stats.dump_stats(os.path.join(profile_dir, name + ".prof"))
+            stats.stream = output
+            stats.sort_stats("cumulative").print_stats(top)
+            stats.sort_stats("tottime").print_callers(top)
+        return output.getvalue()
+
+
+def run_load(target, method, path, data, requests, concurrency):
+    """
+    Sends requests to a route from concurrency threads at once.
+
+    Args:
+        target (TestClientTarget or ServerTarget): where to send requests
+        method (string): HTTP method
+        path (string): path and query string
+        data (dict): form data, or None
+        requests (int): total number of requests
+        concurrency (int): number of threads sending requests
+
+    Returns:
+        dict: requests per second, latency percentiles and errors
+    """
+    remaining = [requests]
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+
+    def worker():
+        send = target.sender()
+        mine = []
+        failed = 0
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+            start = time.perf_counter()
+            try:
+                status = send(method, path, data)
+            except OSError:
+                status = None
+            mine.append(time.perf_counter() - start)
+            if status is None or status >= 400:
+                failed += 1
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": requests,
+        "errors": errors[0],
+        "seconds": elapsed,
+        "requests_per_second": requests / elapsed if elapsed else None,
+        "latency_ms": percentiles(sorted(t * 1000 for t in latencies)),
+    }
+
+
+def percentiles(values):
+    """
+    Args:
+        values (list): sorted list of numbers
+
+    Returns:
+        dict: p50, p90, p99 and max of values, or None if empty
+    """
+    if not values:
+        return None
+    result = {}
+    for name, q in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+        result[name] = values[min(len(values) - 1, int(q * len(values)))]
+    result["max"] = values[-1]
+    return result
+
+
+def main():
+    """
+    Parses arguments, benchmarks every chosen route against every chosen
+    target and concurrency and writes the results as JSON.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the routes of the Flask app.")
+    parser.add_argument("--routes", nargs="+", choices=[route[0] for route in ROUTES],
+                        default=[route[0] for route in ROUTES])
+    parser.add_argument("--targets", nargs="+", choices=TARGETS, default=TARGETS)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--requests", type=int, default=500, help="requests per route, target and concurrency")
+    parser.add_argument("--warmup", type=int, default=20, help="requests per route before measuring")
+    parser.add_argument("--csv", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "allegiance.csv"),
+                        help="allegiances csv file to serve (default is the one next to this file)")
+    parser.add_argument("--profile", action="store_true",
+                        help="profile every request and print the hottest call stacks of each route")
+    parser.add_argument("--profile-top", type=int, default=15, help="functions listed per route when profiling")
+    parser.add_argument("--profile-dir", help="directory to write each route's profile to when profiling")
+    parser.add_argument("--output", help="file to write JSON results to (default is stdout)")
+    args = parser.parse_args()
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    app = assignment_4.app
+    assignment_4.allegiances = assignment_4.AllegianceCache(args.csv)
+    profiler = None
+    if args.profile:
+        profiler = app.wsgi_app = ProfilerMiddleware(app.wsgi_app)
+
+    results = []
+    for target_name in args.targets:
+        target = TestClientTarget(app) if target_name == "test-client" else ServerTarget(app)
+        target.start()
+        try:
+            for name, method, path, data in ROUTES:
+                if name not in args.routes:
+                    continue
+                run_load(target, method, path, data, args.warmup, 1)
+                for concurrency in args.concurrency:
+                    result = run_load(target, method, path, data, args.requests, concurrency)
+                    result.update({"route": name, "target": target_name, "concurrency": concurrency})
+                    latency = result["latency_ms"] or {}
+                    print(f"{target_name} {name} x{concurrency}: "
+                          f"{result['requests_per_second']:.0f} req/s, "
+                          f"p50 {latency.get('p50', 0):.2f}ms, p99 {latency.get('p99', 0):.2f}ms, "
+                          f"{result['errors']} errors",
+                          file=sys.stderr)
+                    results.append(result)
+        finally:
+            target.stop()
+
+    if profiler is not None:
+        if args.profile_dir:
+            os.makedirs(args.profile_dir, exist_ok=True)
+        print(profiler.report(args.profile_top, args.profile_dir), file=sys.stderr)
+
+    report = {
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "python": platform.python_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()